@@ -32,7 +32,6 @@ __contributors__ = "jwagnerhki, Bob Ippolito, Michael Leonhard, Giuseppe Scrivan
 # - Use a single IMAP command to fetch the messages
 # - Patch Python's ssl module to do proper checking of certificate chain
 # - Patch Python's ssl module to raise good exceptions
-# - Submit patch of socket._fileobject.read
 # - Improve imaplib module with LIST parsing code, submit patch
 # DONE:
 # v1.4h
@@ -47,27 +46,57 @@ import os
 import gc
 import sys
 import time
+import random
 import getopt
-import mailbox
+import collections
+import concurrent.futures
+import queue
+import threading
+import functools
+import mmap
 import imaplib
 import socket
 import re
 import hashlib
 import subprocess
-import tempfile
+import importlib.util
 
-# Try to import YAML, but make it optional
-try:
-    import yaml
-    HAS_YAML = True
-except ImportError:
-    HAS_YAML = False
+# YAML and boto3 are optional and slow to import, they are only looked up
+# here and imported when a config file is loaded or S3 is used
+HAS_YAML = importlib.util.find_spec('yaml') is not None
+# the AWS CLI is used for S3 transfers without boto3
+HAS_BOTO3 = importlib.util.find_spec('boto3') is not None
+boto3 = None  # set by import_boto3()
 
 class SkipFolderException(Exception):
     """Indicates aborting processing of current folder, continue with next folder."""
     pass
 
 
+class BufferedReadMixin:
+    """Reads server responses through a large buffer
+
+    imaplib wraps the socket in a file with the default 8 KiB buffer, so
+    large FETCH responses take many small recv() calls.
+    """
+
+    def open(self, *args, **kwargs):
+        super().open(*args, **kwargs)
+        # nothing has been read yet, the greeting is read after open()
+        self.file.close()
+        self.file = self.sock.makefile('rb', buffering=IMAP_READ_BUFFER)
+
+
+class IMAP4(BufferedReadMixin, imaplib.IMAP4):
+    """imaplib.IMAP4 with a large read buffer"""
+    pass
+
+
+class IMAP4_SSL(BufferedReadMixin, imaplib.IMAP4_SSL):
+    """imaplib.IMAP4_SSL with a large read buffer"""
+    pass
+
+
 class Spinner:
     """Prints out message with cute spinner, indicating progress"""
 
@@ -85,6 +114,8 @@ class Spinner:
         self.nospinner = nospinner
         self.total = total
         self.current = 0
+        self.active = not nospinner and sys.stdin.isatty()
+        self.last_paint = None  # (time, percentage) of the last repaint
         sys.stdout.write(message)
         sys.stdout.flush()
         self.spin()
@@ -100,66 +131,105 @@ class Spinner:
             self.current = current
         if message is not None:
             self.message = message
+            self.last_paint = None
         self.spin()
 
     def spin(self):
-        """Rotate the spinner"""
-        if sys.stdin.isatty() and not self.nospinner:
+        """Rotate the spinner, repainting at most every SPINNER_INTERVAL seconds"""
+        if self.active:
             display_msg = self.message
+            percentage = None
 
             # Add progress if total is set
             if self.total is not None and self.total > 0:
-                percentage = int((self.current / self.total) * 100)
+                percentage = self.current * 100 // self.total
                 display_msg = "%s (%d/%d, %d%%)" % (self.message, self.current, self.total, percentage)
 
+            # a new percentage or the final count is always shown
+            now = time.monotonic()
+            if (self.last_paint is not None and now - self.last_paint[0] < SPINNER_INTERVAL
+                    and percentage == self.last_paint[1]
+                    and (self.total is None or self.current < self.total)):
+                return
+            self.last_paint = (now, percentage)
+
             sys.stdout.write("\r" + display_msg + " " + self.glyphs[self.pos])
             sys.stdout.flush()
             self.pos = (self.pos+1) % len(self.glyphs)
 
     def stop(self):
         """Erase the spinner from the screen"""
-        if sys.stdin.isatty() and not self.nospinner:
+        if self.active:
             display_msg = self.message
 
             # Add final progress if total is set
             if self.total is not None and self.total > 0:
                 display_msg = "%s (%d/%d, 100%%)" % (self.message, self.total, self.total)
 
-            sys.stdout.write("\r" + display_msg + "  ")
-            sys.stdout.write("\r" + display_msg)
+            # clear the glyph and leave the cursor after the message, in one write
+            sys.stdout.write("\r%s  \r%s" % (display_msg, display_msg))
             sys.stdout.flush()
 
 
+# Units for pretty_byte_count, indexed by the number of whole 1024 steps
+BYTE_UNITS = (
+    (1, "%d bytes"),
+    (1024.0, "%.2f KB"),
+    (1048576.0, "%.3f MB"),
+    (1073741824.0, "%.3f GB"),
+    (1099511627776.0, "%.3f TB"),
+)
+
+
 def pretty_byte_count(num):
     """Converts integer into a human friendly count of bytes, eg: 12.243 MB"""
     if num == 1:
         return "1 byte"
-    elif num < 1024:
-        return "%s bytes" % num
-    elif num < 1048576:
-        return "%.2f KB" % (num/1024.0)
-    elif num < 1073741824:
-        return "%.3f MB" % (num/1048576.0)
-    elif num < 1099511627776:
-        return "%.3f GB" % (num/1073741824.0)
-    else:
-        return "%.3f TB" % (num/1099511627776.0)
+    # every 10 bits is one step of 1024
+    divisor, fmt = BYTE_UNITS[min(len(BYTE_UNITS) - 1, max(0, (int(num).bit_length() - 1) // 10))]
+    return fmt % (num / divisor)
 
 
 # Regular expressions for parsing
-MSGID_RE = re.compile(r"^Message-Id: (.+)", re.IGNORECASE + re.MULTILINE)
-BLANKS_RE = re.compile(r'\s+', re.MULTILINE)
+MSGID_RE = re.compile(r"Message-Id: (\S.*)", re.IGNORECASE)
+BLANKS_RE = re.compile(r'\s+')
+CRLF_RE = re.compile(rb'\r\n|\r|\n')  # Line endings, IMAP literals use CRLF
+FROM_RE = re.compile(rb"\n(>*)From ")  # mboxrd quoting of "From " lines in message bodies
+FETCH_NUM_RE = re.compile(rb'^\s*(\d+)\s')  # Message number at the start of a FETCH response
+FETCH_SIZE_RE = re.compile(rb'^\s*(\d+)\s+\(.*RFC822\.SIZE\s+(\d+)', re.IGNORECASE)
+# NOTE: RFC3501 doesn't fully define the format of name attributes
+NAME_ATTRIB_RE = re.compile(r"\s*(\\[a-zA-Z0-9_]+)\s*")
+STRING_LIST_RE = re.compile(r'\s*"([^"]+)"\s*|\s*(\S+)\s*')
 
 # Constants
 UUID = '19AF1258-1AAF-44EF-9D9A-731079D6FAD7'  # Used to generate Message-Ids
+MSGID_INDEX_DIR = '.imapbackup-index'  # Directory under basedir holding the Message-Id indexes, outside the mbox tree
+MSGID_INDEX_SUFFIX = '.msgids'  # Index file listing the Message-Ids stored in an mbox
+MSGID_INDEX_HEADER = '# %020d %020d\n'  # First index line, size and st_mtime_ns of the mbox it describes
+SPINNER_INTERVAL = 0.1  # Minimum seconds between spinner repaints
 
 # Retry configuration
 DEFAULT_MAX_RETRIES = 3
 DEFAULT_RETRY_DELAY = 1.0  # seconds
 DEFAULT_RETRY_BACKOFF = 2.0  # exponential backoff multiplier
+MAX_RETRY_DELAY = 32.0  # seconds, upper bound for a single retry delay
+
+# S3 transfer configuration (boto3 only)
+S3_MULTIPART_CHUNKSIZE = 32 * 1024 * 1024  # bytes per multipart part
+S3_MAX_CONCURRENCY = 8  # parts transferred in parallel
+S3_IO_CHUNKSIZE = 1 << 20  # bytes per read from the file being transferred
+S3_UPLOAD_WORKERS = 4  # files uploaded in parallel
 
 # Memory optimization configuration
 FETCH_BATCH_SIZE = 1000  # Number of messages to fetch headers for in one batch
+SCAN_PIPELINE_DEPTH = 4  # Header FETCH batches in flight while scanning a folder
+MBOX_WRITE_BUFFER = 1 << 20  # Buffer size in bytes for writing mbox files
+IMAP_READ_BUFFER = 1 << 20  # Buffer size in bytes for reading server responses
+DOWNLOAD_BATCH_SIZE = 50  # Maximum number of full messages to fetch in one batch
+DOWNLOAD_BATCH_BYTES = 16 * 1024 * 1024  # Maximum total message size of one batch
+DOWNLOAD_PIPELINE_DEPTH = 2  # Download FETCH batches in flight, each up to DOWNLOAD_BATCH_BYTES
+APPEND_WINDOW = 16  # Maximum number of APPEND commands in flight with LITERAL+
+TCP_KEEPALIVE_OPTIONS = (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 30), ('TCP_KEEPCNT', 4))  # Where the platform has them
 
 
 def retry_on_network_error(func, max_retries=DEFAULT_MAX_RETRIES, delay=DEFAULT_RETRY_DELAY, backoff=DEFAULT_RETRY_BACKOFF, operation_name=None):
@@ -185,24 +255,25 @@ def retry_on_network_error(func, max_retries=DEFAULT_MAX_RETRIES, delay=DEFAULT_
     for attempt in range(max_retries):
         try:
             return func()
+        # only network errors are retried, anything else propagates as is
         except (socket.error, socket.timeout, imaplib.IMAP4.error) as e:
             last_exception = e
             if attempt < max_retries - 1:  # Don't sleep on last attempt
                 retry_msg = "Attempt %d/%d failed" % (attempt + 1, max_retries)
                 if operation_name:
                     retry_msg = "%s: %s" % (operation_name, retry_msg)
-                retry_msg += ". Retrying in %.1f seconds..." % current_delay
+                # random jitter keeps connections that failed together
+                # from retrying in lockstep
+                sleep_time = min(current_delay + random.uniform(0, current_delay / 2), MAX_RETRY_DELAY)
+                retry_msg += ". Retrying in %.1f seconds..." % sleep_time
                 print ("\n  %s" % retry_msg)
-                time.sleep(current_delay)
-                current_delay *= backoff
+                time.sleep(sleep_time)
+                current_delay = min(current_delay * backoff, MAX_RETRY_DELAY)
             else:
                 error_msg = "All %d attempts failed" % max_retries
                 if operation_name:
                     error_msg = "%s: %s" % (operation_name, error_msg)
                 print ("\n  %s" % error_msg)
-        except Exception as e:
-            # For non-network errors, don't retry
-            raise
 
     # All retries exhausted
     raise last_exception
@@ -228,6 +299,20 @@ def string_from_file(value):
         return content.read().strip()
 
 
+# Results of import_gpg_key by SHA-256 of the key material
+IMPORTED_GPG_KEYS = {}
+
+
+@functools.lru_cache(maxsize=None)
+def have_tool(tool):
+    """Returns True if the external tool runs, checked once per process"""
+    try:
+        subprocess.run([tool, '--version'], capture_output=True, check=True)
+        return True
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return False
+
+
 def import_gpg_key(source):
     """
     Import a GPG public key from various sources.
@@ -249,9 +334,7 @@ def import_gpg_key(source):
         source_description = ""
 
         # Check if GPG is available
-        try:
-            subprocess.run(['gpg', '--version'], capture_output=True, check=True)
-        except (subprocess.CalledProcessError, FileNotFoundError):
+        if not have_tool('gpg'):
             raise Exception("GPG not found. Please install GPG (gnupg) to use key import.")
 
         # 1. Check environment variable
@@ -328,66 +411,63 @@ def import_gpg_key(source):
         if '-----BEGIN PGP PUBLIC KEY BLOCK-----' not in key_content:
             raise Exception("Invalid GPG key format (missing PGP PUBLIC KEY BLOCK header)")
 
-        # Import the key using GPG
-        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.asc') as f:
-            f.write(key_content)
-            temp_key_file = f.name
+        # The same key is often configured for every account
+        key_digest = hashlib.sha256(key_content.encode('utf-8')).digest()
+        if key_digest in IMPORTED_GPG_KEYS:
+            print("  GPG key from %s already imported" % source_description)
+            return IMPORTED_GPG_KEYS[key_digest]
 
+        # Import the key using GPG, the key is piped in on stdin
+        # First, extract fingerprint using show-only
+        fingerprint = None
         try:
-            # First, extract fingerprint using show-only
-            fingerprint = None
+            show_cmd = ['gpg', '--batch', '--import-options', 'show-only', '--import', '--with-colons']
+            show_result = subprocess.run(show_cmd, input=key_content, capture_output=True, text=True, check=True)
+            for line in show_result.stdout.split('\n'):
+                if line.startswith('fpr:'):
+                    fields = line.split(':')
+                    if len(fields) >= 10 and len(fields[9]) == 40:
+                        fingerprint = fields[9]
+                        print("  Extracted fingerprint: %s" % fingerprint)
+                        break
+        except:
+            pass  # Will try after import
+
+        # Import the key
+        cmd = ['gpg', '--batch', '--import']
+        result = subprocess.run(cmd, input=key_content, capture_output=True, text=True, check=True)
+
+        # Check if key was skipped due to missing user ID
+        if 'contains no user ID' in result.stderr or 'w/o user IDs' in result.stderr:
+            print("\nERROR: GPG key import failed - key has no user ID")
+            print("ERROR: The key from '%s' does not contain a user ID." % source_description)
+            print("ERROR: This typically happens with keys from keys.openpgp.org when the email isn't verified.")
+            print("ERROR:")
+            print("ERROR: Solutions:")
+            print("ERROR: 1. Verify your email on keys.openpgp.org and use the by-email URL")
+            print("ERROR: 2. Provide the full PGP public key block directly (with user ID)")
+            print("ERROR: 3. Upload your key to keyserver.ubuntu.com with full user ID")
+            return None
+
+        print("  Successfully imported GPG key from %s" % source_description)
+
+        # If fingerprint extraction failed before import, try after
+        if not fingerprint:
             try:
-                show_cmd = ['gpg', '--batch', '--import-options', 'show-only', '--import', '--with-colons', temp_key_file]
-                show_result = subprocess.run(show_cmd, capture_output=True, text=True, check=True)
-                for line in show_result.stdout.split('\n'):
+                list_cmd = ['gpg', '--batch', '--list-keys', '--with-colons']
+                list_result = subprocess.run(list_cmd, capture_output=True, text=True, check=True)
+                for line in list_result.stdout.split('\n'):
                     if line.startswith('fpr:'):
                         fields = line.split(':')
                         if len(fields) >= 10 and len(fields[9]) == 40:
                             fingerprint = fields[9]
-                            print("  Extracted fingerprint: %s" % fingerprint)
                             break
             except:
-                pass  # Will try after import
-
-            # Import the key
-            cmd = ['gpg', '--batch', '--import', temp_key_file]
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-
-            # Check if key was skipped due to missing user ID
-            if 'contains no user ID' in result.stderr or 'w/o user IDs' in result.stderr:
-                print("\nERROR: GPG key import failed - key has no user ID")
-                print("ERROR: The key from '%s' does not contain a user ID." % source_description)
-                print("ERROR: This typically happens with keys from keys.openpgp.org when the email isn't verified.")
-                print("ERROR:")
-                print("ERROR: Solutions:")
-                print("ERROR: 1. Verify your email on keys.openpgp.org and use the by-email URL")
-                print("ERROR: 2. Provide the full PGP public key block directly (with user ID)")
-                print("ERROR: 3. Upload your key to keyserver.ubuntu.com with full user ID")
-                return None
-
-            print("  Successfully imported GPG key from %s" % source_description)
-
-            # If fingerprint extraction failed before import, try after
-            if not fingerprint:
-                try:
-                    list_cmd = ['gpg', '--batch', '--list-keys', '--with-colons']
-                    list_result = subprocess.run(list_cmd, capture_output=True, text=True, check=True)
-                    for line in list_result.stdout.split('\n'):
-                        if line.startswith('fpr:'):
-                            fields = line.split(':')
-                            if len(fields) >= 10 and len(fields[9]) == 40:
-                                fingerprint = fields[9]
-                                break
-                except:
-                    pass
-
-            # Return fingerprint if found, otherwise True for backwards compatibility
-            return fingerprint if fingerprint else True
+                pass
 
-        finally:
-            # Clean up temp file
-            if os.path.exists(temp_key_file):
-                os.unlink(temp_key_file)
+        # Return fingerprint if found, otherwise True for backwards compatibility
+        IMPORTED_GPG_KEYS[key_digest] = fingerprint if fingerprint else True
+        return IMPORTED_GPG_KEYS[key_digest]
 
     except Exception as e:
         print("  WARNING: Failed to import GPG key: %s" % str(e))
@@ -459,12 +539,50 @@ def decrypt_file_gpg(input_file):
         raise Exception("GPG not found. Please install GPG (gnupg) to use decryption.")
 
 
+def import_boto3():
+    """Imports boto3 and the names used from it on first use"""
+    global boto3, TransferConfig, S3ConnectionError, S3ReadTimeoutError
+    if boto3 is None:
+        from boto3.s3.transfer import TransferConfig
+        from botocore.exceptions import ConnectionError as S3ConnectionError
+        from botocore.exceptions import ReadTimeoutError as S3ReadTimeoutError
+        import boto3
+
+
+def s3_client(config):
+    """Returns a boto3 S3 client for the configured endpoint and credentials
+
+    Every client gets its own session, the default session is not thread safe.
+    """
+    return boto3.session.Session().client('s3',
+                                          endpoint_url=config['s3_endpoint'],
+                                          aws_access_key_id=config['s3_access_key'],
+                                          aws_secret_access_key=config['s3_secret_key'])
+
+
+def s3_transfer_config():
+    """Returns the boto3 multipart transfer settings"""
+    return TransferConfig(multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+                          max_concurrency=S3_MAX_CONCURRENCY,
+                          io_chunksize=S3_IO_CHUNKSIZE)
+
+
+def aws_cli_env(config):
+    """Returns the environment for the AWS CLI, the inherited one plus the S3 credentials
+
+    The whole environment is passed on because the CLI also honours proxy,
+    CA bundle and region settings from it.
+    """
+    env = dict(os.environ)
+    env['AWS_ACCESS_KEY_ID'] = config['s3_access_key']
+    env['AWS_SECRET_ACCESS_KEY'] = config['s3_secret_key']
+    return env
+
+
 def download_from_s3(filename, config, destination_dir):
-    """Download a file from S3-compatible storage using AWS CLI with retry logic"""
+    """Download a file from S3-compatible storage using boto3 or the AWS CLI with retry logic"""
     # Check if aws CLI is available
-    try:
-        subprocess.run(['aws', '--version'], capture_output=True, check=True)
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    if not HAS_BOTO3 and not have_tool('aws'):
         raise Exception("AWS CLI not found. Please install awscli to use S3 download.")
 
     # Prepare S3 object key
@@ -479,31 +597,41 @@ def download_from_s3(filename, config, destination_dir):
     # Destination path
     destination_path = os.path.join(destination_dir, filename)
 
-    # Set up environment variables for AWS credentials
-    env = os.environ.copy()
-    env['AWS_ACCESS_KEY_ID'] = config['s3_access_key']
-    env['AWS_SECRET_ACCESS_KEY'] = config['s3_secret_key']
-
-    # Build AWS CLI command
-    cmd = [
-        'aws', 's3', 'cp',
-        s3_uri,
-        destination_path,
-        '--endpoint-url', config['s3_endpoint']
-    ]
-
     print ("  Downloading from S3: %s" % s3_uri)
 
     # Retry logic for S3 download
-    def download_operation():
-        try:
-            result = subprocess.run(cmd, env=env, capture_output=True, text=True, check=True, timeout=300)
-            return result
-        except subprocess.CalledProcessError as e:
-            # Treat S3 download failures as network errors that should be retried
-            raise socket.error("S3 download failed: %s" % e.stderr)
-        except subprocess.TimeoutExpired:
-            raise socket.timeout("S3 download timed out")
+    if HAS_BOTO3:
+        import_boto3()
+
+        def download_operation():
+            try:
+                return s3_client(config).download_file(
+                    config['s3_bucket'], s3_key, destination_path, Config=s3_transfer_config())
+            except (S3ConnectionError, S3ReadTimeoutError) as e:
+                # Only connection problems are retried, errors like bad
+                # credentials or a missing bucket are permanent
+                raise socket.error("S3 download failed: %s" % str(e))
+    else:
+        env = aws_cli_env(config)
+
+        # Build AWS CLI command
+        cmd = [
+            'aws', 's3', 'cp',
+            s3_uri,
+            destination_path,
+            '--endpoint-url', config['s3_endpoint'],
+            '--only-show-errors'  # no progress output to capture
+        ]
+
+        def download_operation():
+            try:
+                result = subprocess.run(cmd, env=env, capture_output=True, text=True, check=True, timeout=300)
+                return result
+            except subprocess.CalledProcessError as e:
+                # Treat S3 download failures as network errors that should be retried
+                raise socket.error("S3 download failed: %s" % e.stderr)
+            except subprocess.TimeoutExpired:
+                raise socket.timeout("S3 download timed out")
 
     try:
         retry_on_network_error(
@@ -518,11 +646,9 @@ def download_from_s3(filename, config, destination_dir):
 
 
 def upload_to_s3(file_path, config):
-    """Upload a file to S3-compatible storage using AWS CLI with retry logic"""
+    """Upload a file to S3-compatible storage using boto3 or the AWS CLI with retry logic"""
     # Check if aws CLI is available
-    try:
-        subprocess.run(['aws', '--version'], capture_output=True, check=True)
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    if not HAS_BOTO3 and not have_tool('aws'):
         raise Exception("AWS CLI not found. Please install awscli to use S3 upload.")
 
     # Prepare S3 object key
@@ -535,31 +661,41 @@ def upload_to_s3(file_path, config):
 
     s3_uri = 's3://%s/%s' % (config['s3_bucket'], s3_key)
 
-    # Set up environment variables for AWS credentials
-    env = os.environ.copy()
-    env['AWS_ACCESS_KEY_ID'] = config['s3_access_key']
-    env['AWS_SECRET_ACCESS_KEY'] = config['s3_secret_key']
-
-    # Build AWS CLI command
-    cmd = [
-        'aws', 's3', 'cp',
-        file_path,
-        s3_uri,
-        '--endpoint-url', config['s3_endpoint']
-    ]
-
     print ("  Uploading to S3: %s" % s3_uri)
 
     # Retry logic for S3 upload
-    def upload_operation():
-        try:
-            result = subprocess.run(cmd, env=env, capture_output=True, text=True, check=True, timeout=300)
-            return result
-        except subprocess.CalledProcessError as e:
-            # Treat S3 upload failures as network errors that should be retried
-            raise socket.error("S3 upload failed: %s" % e.stderr)
-        except subprocess.TimeoutExpired:
-            raise socket.timeout("S3 upload timed out")
+    if HAS_BOTO3:
+        import_boto3()
+
+        def upload_operation():
+            try:
+                return s3_client(config).upload_file(
+                    file_path, config['s3_bucket'], s3_key, Config=s3_transfer_config())
+            except (S3ConnectionError, S3ReadTimeoutError) as e:
+                # Only connection problems are retried, errors like bad
+                # credentials or a missing bucket are permanent
+                raise socket.error("S3 upload failed: %s" % str(e))
+    else:
+        env = aws_cli_env(config)
+
+        # Build AWS CLI command
+        cmd = [
+            'aws', 's3', 'cp',
+            file_path,
+            s3_uri,
+            '--endpoint-url', config['s3_endpoint'],
+            '--only-show-errors'  # no progress output to capture
+        ]
+
+        def upload_operation():
+            try:
+                result = subprocess.run(cmd, env=env, capture_output=True, text=True, check=True, timeout=300)
+                return result
+            except subprocess.CalledProcessError as e:
+                # Treat S3 upload failures as network errors that should be retried
+                raise socket.error("S3 upload failed: %s" % e.stderr)
+            except subprocess.TimeoutExpired:
+                raise socket.timeout("S3 upload timed out")
 
     try:
         retry_on_network_error(
@@ -573,6 +709,28 @@ def upload_to_s3(file_path, config):
         raise Exception("S3 upload failed after retries: %s" % str(e))
 
 
+def can_pipeline_append(server):
+    """Returns True if APPEND commands can be sent without waiting for the server
+
+    Needs non-synchronizing literals (LITERAL+, RFC 7888), otherwise every
+    APPEND waits for a continuation before its message can be sent.
+    """
+    return ('LITERAL+' in getattr(server, 'capabilities', ())
+            and not getattr(server, 'utf8_enabled', False))
+
+
+def send_append(server, mailbox, message):
+    """Sends an APPEND with a non-synchronizing literal, returns its tag
+
+    The response is read later with server._command_complete('APPEND', tag).
+    """
+    literal = CRLF_RE.sub(b'\r\n', message)
+    tag = server._new_tag()
+    server.send(b'%s APPEND %s {%d+}\r\n%s\r\n' % (
+        tag, bytes(mailbox, server._encoding), len(literal), literal))
+    return tag
+
+
 def upload_messages(server, foldername, filename, messages_to_upload, nospinner, basedir):
     """Upload messages from mbox file to IMAP folder
 
@@ -599,26 +757,95 @@ def upload_messages(server, foldername, filename, messages_to_upload, nospinner,
                       nospinner, total=total_messages)
 
     try:
-        # Open the mbox file
+        # Map the mbox file, messages are sliced out of it as raw bytes
+        # instead of being parsed and re-serialised
         try:
-            mbox = mailbox.mbox(fullname)
+            mbox_file = open(fullname, 'rb')
         except (IOError, OSError) as e:
             spinner.stop()
             print ("\nERROR: Cannot open mbox file %s: %s" % (fullname, str(e)))
             return (0, len(messages_to_upload), 0)
+        try:
+            mbox = map_file(mbox_file)
         except Exception as e:
+            mbox_file.close()
             spinner.stop()
             print ("\nERROR: Mailbox file %s is corrupted or invalid: %s" % (fullname, str(e)))
             return (0, len(messages_to_upload), 0)
 
+        foldername_quoted = '"{}"'.format(foldername)
+
+        # With LITERAL+ up to APPEND_WINDOW messages are sent before the
+        # first response is read, instead of one round-trip per message.
+        # After a network error the pipeline is drained and the messages
+        # that were not acknowledged go through the retried single APPEND.
+        pipeline = can_pipeline_append(server)
+        in_flight = collections.deque()
+        unacknowledged = collections.deque()
+
+        def append_one(msg_id, msg_bytes):
+            """APPENDs a single message with retries"""
+            nonlocal uploaded, failed, total_size
+            try:
+                # APPEND the message with retry
+                def append_operation():
+                    return server.append(foldername_quoted, None, None, msg_bytes)
+
+                result = retry_on_network_error(
+                    append_operation,
+                    operation_name="Upload message %s" % msg_id
+                )
+
+                if result[0] == 'OK':
+                    uploaded += 1
+                    total_size += len(msg_bytes)
+                else:
+                    print ("\nWARNING: Failed to upload message with ID %s: %s" % (msg_id, result))
+                    failed += 1
+
+            except (imaplib.IMAP4.error, socket.error, socket.timeout) as e:
+                print ("\nERROR: Network error uploading message %s after retries: %s" % (msg_id, str(e)))
+                failed += 1
+            except Exception as e:
+                print ("\nERROR: Unexpected error uploading message %s: %s" % (msg_id, str(e)))
+                failed += 1
+
+        def complete_append():
+            """Reads the response to the oldest APPEND in flight"""
+            nonlocal uploaded, failed, total_size, pipeline
+            tag, msg_id, msg_bytes = in_flight.popleft()
+            try:
+                result = server._command_complete('APPEND', tag)
+            except (imaplib.IMAP4.error, socket.error, socket.timeout) as e:
+                print ("\nWARNING: Network error uploading message %s, it is sent again: %s" % (msg_id, str(e)))
+                pipeline = False
+                unacknowledged.append((msg_id, msg_bytes))
+                return
+            if result[0] == 'OK':
+                uploaded += 1
+                total_size += len(msg_bytes)
+            else:
+                print ("\nWARNING: Failed to upload message with ID %s: %s" % (msg_id, result))
+                failed += 1
+
+        def finish_pipeline():
+            """Reads all outstanding responses, then resends the unacknowledged messages"""
+            while in_flight:
+                complete_append()
+            while unacknowledged:
+                append_one(*unacknowledged.popleft())
+
         # Iterate through messages in the mbox file
         msg_index = 0
         try:
-            for message in mbox:
+            # Only the header block of each message is copied out of the
+            # mmap; the body is read only for messages being uploaded
+            for start, end in iter_mbox_spans(mbox):
                 try:
                     # Get the Message-Id
                     try:
-                        msg_id = message.get('Message-Id', '').strip()
+                        value = header_value(mbox[start:header_end(mbox, start, end)], 'Message-Id')
+                        msg_id = message_id_from_header("Message-Id: %s" % value) if value else None
                     except Exception as e:
                         print ("\nWARNING: Cannot read Message-Id from message: %s" % str(e))
                         failed += 1
@@ -626,59 +853,50 @@ def upload_messages(server, foldername, filename, messages_to_upload, nospinner,
 
                     # Check if this message needs to be uploaded
                     if msg_id in messages_to_upload:
+                        msg_bytes = mbox[start:end]
                         msg_index += 1
                         spinner.update(current=msg_index)
-                        # Convert message to string (bytes)
-                        try:
-                            msg_bytes = bytes(str(message), 'utf-8')
-                        except Exception as e:
-                            print ("\nERROR: Cannot convert message %s to bytes: %s" % (msg_id, str(e)))
-                            failed += 1
+
+                        if pipeline:
+                            try:
+                                tag = send_append(server, foldername_quoted, msg_bytes)
+                            except (socket.error, socket.timeout) as e:
+                                print ("\nWARNING: Network error uploading message %s, it is sent again: %s" % (msg_id, str(e)))
+                                pipeline = False
+                                unacknowledged.append((msg_id, msg_bytes))
+                            else:
+                                in_flight.append((tag, msg_id, msg_bytes))
+                                if len(in_flight) >= APPEND_WINDOW:
+                                    complete_append()
+                            if not pipeline:
+                                finish_pipeline()
                             continue
 
                         # Upload to IMAP server with retry logic
                         # Use APPEND command to add message to folder
-                        try:
-                            foldername_quoted = '"{}"'.format(foldername)
-
-                            # APPEND the message with retry
-                            def append_operation():
-                                return server.append(foldername_quoted, None, None, msg_bytes)
-
-                            result = retry_on_network_error(
-                                append_operation,
-                                operation_name="Upload message %s" % msg_id
-                            )
-
-                            if result[0] == 'OK':
-                                uploaded += 1
-                                total_size += len(msg_bytes)
-                            else:
-                                print ("\nWARNING: Failed to upload message with ID %s: %s" % (msg_id, result))
-                                failed += 1
-
-                        except (imaplib.IMAP4.error, socket.error, socket.timeout) as e:
-                            print ("\nERROR: Network error uploading message %s after retries: %s" % (msg_id, str(e)))
-                            failed += 1
-                        except Exception as e:
-                            print ("\nERROR: Unexpected error uploading message %s: %s" % (msg_id, str(e)))
-                            failed += 1
+                        append_one(msg_id, msg_bytes)
 
                 except Exception as e:
                     print ("\nERROR: Error processing message for upload: %s" % str(e))
                     failed += 1
 
+            finish_pipeline()
+
         except Exception as e:
             spinner.stop()
             print ("\nERROR: Error reading messages from mbox: %s" % str(e))
             try:
-                mbox.close()
+                if mbox:
+                    mbox.close()
+                mbox_file.close()
             except:
                 pass
             return (uploaded, len(messages_to_upload) - uploaded, total_size)
 
         try:
-            mbox.close()
+            if mbox:
+                mbox.close()
+            mbox_file.close()
         except Exception as e:
             print ("\nWARNING: Error closing mbox file %s: %s" % (filename, str(e)))
 
@@ -697,6 +915,106 @@ def upload_messages(server, foldername, filename, messages_to_upload, nospinner,
         return (uploaded, len(messages_to_upload) - uploaded, total_size)
 
 
+def fetch_message_sizes(server, nums):
+    """Returns a dict of message number -> RFC822.SIZE, missing on errors"""
+    sizes = {}
+    for batch_start in range(0, len(nums), FETCH_BATCH_SIZE):
+        msg_set = compress_sequence_set(nums[batch_start:batch_start + FETCH_BATCH_SIZE])
+        try:
+            def fetch_sizes_operation():
+                return server.fetch(msg_set, '(RFC822.SIZE)')
+
+            typ, data = retry_on_network_error(
+                fetch_sizes_operation,
+                operation_name="Fetch sizes %s" % msg_set
+            )
+        except (imaplib.IMAP4.error, socket.error, socket.timeout) as e:
+            print ("\nWARNING: Cannot fetch message sizes %s: %s" % (msg_set, str(e)))
+            continue
+        if typ != 'OK' or not data:
+            continue
+        for item in data:
+            if isinstance(item, tuple):
+                item = item[0]
+            if not isinstance(item, bytes):
+                continue
+            match = FETCH_SIZE_RE.match(item)
+            if match:
+                sizes[int(match.group(1))] = int(match.group(2))
+    return sizes
+
+
+def download_batches(nums, sizes):
+    """Splits message numbers into batches of at most DOWNLOAD_BATCH_SIZE
+    messages and, where sizes are known, DOWNLOAD_BATCH_BYTES bytes
+
+    A message of unknown size is fetched on its own.
+    """
+    batch = []
+    batch_bytes = 0
+    for num in nums:
+        size = sizes.get(num, DOWNLOAD_BATCH_BYTES)
+        if batch and (len(batch) >= DOWNLOAD_BATCH_SIZE or
+                      batch_bytes + size > DOWNLOAD_BATCH_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(num)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def fetch_message_batches(server, batches, fetch_cmd):
+    """Yields (batch, msg_set, response) for a FETCH of each batch of message numbers
+
+    response is the (typ, data) result, or the exception if the FETCH failed.
+    On imaplib connections the next DOWNLOAD_PIPELINE_DEPTH - 1 batches are
+    requested before a batch is returned, so the server is already sending
+    them while it is written to disk. After an error the remaining batches
+    are fetched one at a time with retries.
+    """
+    batches = collections.deque(batches)
+    in_flight = collections.deque()
+    pipeline = isinstance(server, imaplib.IMAP4)
+
+    while batches or in_flight:
+        if pipeline or in_flight:
+            try:
+                while pipeline and batches and len(in_flight) < DOWNLOAD_PIPELINE_DEPTH:
+                    msg_set = compress_sequence_set(batches[0])
+                    tag = server._command('FETCH', msg_set, fetch_cmd)
+                    in_flight.append((batches.popleft(), msg_set, tag))
+            except (imaplib.IMAP4.error, socket.error, socket.timeout):
+                pipeline = False
+                if not in_flight:
+                    continue
+
+            batch, msg_set, tag = in_flight.popleft()
+            try:
+                typ, data = server._command_complete('FETCH', tag)
+                response = server._untagged_response(typ, data, 'FETCH')
+            except (imaplib.IMAP4.error, socket.error, socket.timeout) as e:
+                pipeline = False
+                response = e
+            yield batch, msg_set, response
+            continue
+
+        batch = batches.popleft()
+        msg_set = compress_sequence_set(batch)
+        try:
+            def fetch_operation():
+                return server.fetch(msg_set, fetch_cmd)
+
+            response = retry_on_network_error(
+                fetch_operation,
+                operation_name="Fetch messages %s" % msg_set
+            )
+        except (imaplib.IMAP4.error, socket.error, socket.timeout) as e:
+            response = e
+        yield batch, msg_set, response
+
+
 def download_messages(server, filename, messages, overwrite, nospinner, thunderbird, basedir, icloud):
     """Download messages from folder and append to mailbox
 
@@ -709,6 +1027,9 @@ def download_messages(server, filename, messages, overwrite, nospinner, thunderb
     failed_count = 0
     total = 0
     biggest = 0
+    # the index is kept up to date if it describes the whole file
+    update_index = overwrite or index_is_current(basedir, filename)
+    downloaded = []
 
     try:
         if overwrite and os.path.exists(fullname):
@@ -719,9 +1040,10 @@ def download_messages(server, filename, messages, overwrite, nospinner, thunderb
                 print ("ERROR: Cannot delete file %s: %s" % (fullname, str(e)))
                 return (0, len(messages), 0)
 
-        # Open disk file for append in binary mode
+        # Open disk file for append in binary mode, with a large buffer so
+        # many small messages turn into few write() calls
         try:
-            mbox = open(fullname, 'ab')
+            mbox = open(fullname, 'ab', buffering=MBOX_WRITE_BUFFER)
         except IOError as e:
             print ("ERROR: Cannot open file %s for writing: %s" % (fullname, str(e)))
             return (0, len(messages), 0)
@@ -735,88 +1057,117 @@ def download_messages(server, filename, messages, overwrite, nospinner, thunderb
         total_messages = len(messages)
         spinner = Spinner("Downloading messages to %s" % filename,
                           nospinner, total=total_messages)
-        from_re = re.compile(b"\n(>*)From ")
 
-        # each new message
+        # fetch messages in batches, one round-trip per batch instead of
+        # one per message. imaplib holds a whole response in memory, so
+        # batches are limited by total size as well as by count
+        by_num = {}
+        for msg_id, num in messages.items():
+            by_num[int(num)] = msg_id
+        nums = sorted(by_num)
+        sizes = fetch_message_sizes(server, nums)
+        fetch_cmd = "(BODY.PEEK[])" if icloud else "(RFC822)"
+
         msg_index = 0
-        for msg_id in messages.keys():
-            msg_index += 1
-            spinner.update(current=msg_index)
-            try:
-                # This "From" and the terminating newline below delimit messages
-                # in mbox files.  Note that RFC 4155 specifies that the date be
-                # in the same format as the output of ctime(3), which is required
-                # by ISO C to use English day and month abbreviations.
-                buf = "From nobody %s\n" % time.ctime()
-                # If this is one of our synthesised Message-IDs, insert it before
-                # the other headers
-                if UUID in msg_id:
-                    buf = buf + "Message-Id: %s\n" % msg_id
-
-                # convert to bytes before writing to file of type binary
-                buf_bytes=bytes(buf,'utf-8')
-                mbox.write(buf_bytes)
-
-                # fetch message with retry logic
-                msg_id_str = str(messages[msg_id])
-                try:
-                    def fetch_operation():
-                        return server.fetch(msg_id_str, "(BODY.PEEK[])" if icloud else "(RFC822)")
-
-                    typ, data = retry_on_network_error(
-                        fetch_operation,
-                        operation_name="Fetch message %s" % msg_id_str
-                    )
-                except (imaplib.IMAP4.error, socket.error, socket.timeout) as e:
-                    print ("\nWARNING: Failed to fetch message %s after retries: %s" % (msg_id_str, str(e)))
-                    failed_count += 1
-                    continue
+        outstanding = set(nums)
+        for batch, msg_set, response in fetch_message_batches(server, download_batches(nums, sizes), fetch_cmd):
+            if isinstance(response, Exception):
+                print ("\nWARNING: Failed to fetch messages %s after retries: %s" % (msg_set, str(response)))
+                failed = outstanding.intersection(batch)
+                outstanding.difference_update(failed)
+                failed_count += len(failed)
+                msg_index += len(failed)
+                spinner.update(current=msg_index)
+                continue
 
-                if typ != 'OK' or not data or not data[0]:
-                    print ("\nWARNING: FETCH returned unexpected response for message %s" % msg_id_str)
-                    failed_count += 1
-                    continue
+            typ, data = response
+            if typ != 'OK' or not data:
+                print ("\nWARNING: FETCH returned unexpected response for messages %s" % msg_set)
+                failed = outstanding.intersection(batch)
+                outstanding.difference_update(failed)
+                failed_count += len(failed)
+                msg_index += len(failed)
+                spinner.update(current=msg_index)
+                continue
 
-                try:
-                    data_bytes = data[0][1]
-                except (IndexError, TypeError) as e:
-                    print ("\nWARNING: Cannot extract data from message %s: %s" % (msg_id_str, str(e)))
-                    failed_count += 1
+            # messages are matched by number, a server running pipelined
+            # commands concurrently may answer for a later batch here
+            for item in data:
+                if not isinstance(item, tuple) or len(item) < 2:
                     continue
-
-                text_bytes = data_bytes.strip().replace(b'\r', b'')
-                if thunderbird:
-                    # This avoids Thunderbird mistaking a line starting "From  " as the start
-                    # of a new message. _Might_ also apply to other mail lients - unknown
-                    text_bytes = text_bytes.replace(b"\nFrom ", b"\n From ")
-                else:
-                    # Perform >From quoting as described by RFC 4155 and the qmail docs.
-                    # https://www.rfc-editor.org/rfc/rfc4155.txt
-                    # http://qmail.org/qmail-manual-html/man5/mbox.html
-                    text_bytes = from_re.sub(b"\n>\\1From ", text_bytes)
-
-                try:
-                    mbox.write(text_bytes)
-                    mbox.write(b'\n\n')
-                except IOError as e:
-                    print ("\nERROR: Failed to write message %s to disk: %s" % (msg_id_str, str(e)))
-                    failed_count += 1
+                match = FETCH_NUM_RE.match(item[0])
+                if not match:
                     continue
+                num = int(match.group(1))
+                if num not in outstanding:
+                    continue
+                outstanding.discard(num)
+                msg_id = by_num[num]
+                msg_index += 1
+                spinner.update(current=msg_index)
+                try:
+                    # This "From" and the terminating newline below delimit messages
+                    # in mbox files.  Note that RFC 4155 specifies that the date be
+                    # in the same format as the output of ctime(3), which is required
+                    # by ISO C to use English day and month abbreviations.
+                    buf = "From nobody %s\n" % time.ctime()
+                    # If this is one of our synthesised Message-IDs, insert it before
+                    # the other headers
+                    if UUID in msg_id:
+                        buf = buf + "Message-Id: %s\n" % msg_id
+
+                    # convert to bytes before writing to file of type binary
+                    buf_bytes=bytes(buf,'utf-8')
+
+                    text_bytes = item[1].translate(None, b'\r').strip()
+                    if thunderbird:
+                        # This avoids Thunderbird mistaking a line starting "From  " as the start
+                        # of a new message. _Might_ also apply to other mail lients - unknown
+                        text_bytes = text_bytes.replace(b"\nFrom ", b"\n From ")
+                    else:
+                        # Perform >From quoting as described by RFC 4155 and the qmail docs.
+                        # https://www.rfc-editor.org/rfc/rfc4155.txt
+                        # http://qmail.org/qmail-manual-html/man5/mbox.html
+                        # Every match contains "From ", most messages have none
+                        if b"From " in text_bytes:
+                            if b"\n>" in text_bytes:
+                                text_bytes = FROM_RE.sub(b"\n>\\1From ", text_bytes)
+                            else:
+                                # no quoted lines yet, so a plain replace is equivalent
+                                text_bytes = text_bytes.replace(b"\nFrom ", b"\n>From ")
 
-                size = len(text_bytes)
-                biggest = max(size, biggest)
-                total += size
-                success_count += 1
+                    try:
+                        # single write per message, so a failed fetch never
+                        # leaves a stray "From " line behind
+                        mbox.write(b''.join((buf_bytes, text_bytes, b'\n\n')))
+                    except IOError as e:
+                        print ("\nERROR: Failed to write message %s to disk: %s" % (num, str(e)))
+                        failed_count += 1
+                        continue
+                    downloaded.append(msg_id)
 
-                del data
-                gc.collect()
+                    size = len(text_bytes)
+                    biggest = max(size, biggest)
+                    total += size
+                    success_count += 1
 
-            except Exception as e:
-                # Catch-all for unexpected errors
-                print ("\nERROR: Unexpected error processing message %s: %s" % (msg_id, str(e)))
+                except Exception as e:
+                    # Catch-all for unexpected errors
+                    print ("\nERROR: Unexpected error processing message %s: %s" % (msg_id, str(e)))
+                    failed_count += 1
+
+            # the command for this batch is complete, anything missing is not coming
+            for num in sorted(outstanding.intersection(batch)):
+                outstanding.discard(num)
+                print ("\nWARNING: FETCH returned no data for message %s" % num)
                 failed_count += 1
+                msg_index += 1
+                spinner.update(current=msg_index)
+            del data
 
         mbox.close()
+        if update_index:
+            write_index(basedir, filename, downloaded, append=not overwrite)
         spinner.stop()
 
         if failed_count > 0:
@@ -830,12 +1181,243 @@ def download_messages(server, filename, messages, overwrite, nospinner, thunderb
 
     except Exception as e:
         print ("ERROR: Fatal error in download_messages for %s: %s" % (filename, str(e)))
+        remove_index(basedir, filename)
         return (success_count, len(messages) - success_count, total)
 
 
+def map_file(f):
+    """Maps an open file read-only, returns b'' for empty files which cannot be mapped
+
+    mbox files are read front to back, so the kernel is told to read ahead
+    where the platform supports it.
+    """
+    if os.fstat(f.fileno()).st_size:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        return mapped
+    return b''
+
+
+def iter_mbox_headers(mbox):
+    """Yields the raw header block (bytes) of each message in an mbox buffer (bytes or mmap)
+
+    Only the lines between a "From " separator and the first blank line are
+    copied out, message bodies are skipped with find(), so memory use and
+    allocations do not depend on the size of the messages.
+    """
+    size = len(mbox)
+    if mbox[:5] == b'From ':
+        pos = 0
+    else:
+        pos = mbox.find(b'\nFrom ')
+        if pos == -1:
+            return
+        pos += 1
+    while pos < size:
+        # skip the "From " line
+        start = mbox.find(b'\n', pos)
+        if start == -1:
+            # separator without a message
+            yield b''
+            return
+        start += 1
+
+        if mbox[start:start + 5] == b'From ':
+            # message without headers or body
+            yield b''
+            pos = start
+            continue
+        if mbox[start:start + 1] == b'\n' or mbox[start:start + 2] == b'\r\n':
+            # message without headers
+            yield b''
+            end = start
+        else:
+            # headers end at the first blank line, or at the next separator
+            # for a message without a body
+            end = size
+            for sep in (b'\n\n', b'\n\r\n', b'\nFrom '):
+                found = mbox.find(sep, start, end)
+                if found != -1:
+                    end = found + 1
+            yield mbox[start:end]
+
+        # find the next separator
+        pos = mbox.find(b'\nFrom ', end - 1)
+        if pos == -1:
+            return
+        pos += 1
+
+
+def header_value(header_block, name):
+    """Returns the (unfolded) value of the first header called name, or None"""
+    prefix = name.lower().encode('ascii') + b':'
+    value = None
+    for line in header_block.splitlines():
+        if value is not None:
+            if line[:1] in (b' ', b'\t'):
+                # continuation of a folded header
+                value.append(line)
+                continue
+            break
+        if line[:len(prefix)].lower() == prefix:
+            value = [line[len(prefix):].lstrip(b' \t')]
+    if value is None:
+        return None
+    return str(b'\n'.join(value), 'utf-8', 'replace')
+
+
+def message_id_from_header(header):
+    """Returns the Message-Id key for a "Message-Id: value" header, or None
+
+    Whitespace is collapsed first, which also removes the newlines some
+    servers put inside Message-Ids (a dumb Exchange trait).
+    """
+    header = ' '.join(header.split())
+    # plain "Message-Id: <...>" headers skip the regex, the key is the same
+    if header[:12].lower() == 'message-id: ':
+        return header[12:]
+    match = MSGID_RE.match(header)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def header_end(message, start=0, end=None):
+    """Returns the offset of the blank line ending the headers of a raw message
+
+    start and end bound the search, so a message inside a larger buffer can
+    be handled without slicing it out first.
+    """
+    if end is None:
+        end = len(message)
+    for sep in (b'\n\n', b'\n\r\n'):
+        pos = message.find(sep, start, end)
+        if pos != -1:
+            end = pos + 1
+    return end
+
+
+def iter_mbox_spans(mbox):
+    """Yields the (start, end) offsets of each message in an mbox buffer (bytes or mmap)
+
+    The "From " separator line is excluded, as is the blank line written
+    before the next separator, so the span matches what was downloaded.
+    """
+    if mbox[:5] == b'From ':
+        pos = 0
+    else:
+        pos = mbox.find(b'\nFrom ')
+        if pos == -1:
+            return
+        pos += 1
+    size = len(mbox)
+    while pos < size:
+        start = mbox.find(b'\n', pos)
+        if start == -1:
+            return
+        start += 1
+        end = mbox.find(b'\nFrom ', start)
+        if end == -1:
+            end = pos = size
+        else:
+            end = pos = end + 1
+        # drop the separating blank line
+        if end - start >= 2 and mbox[end - 2:end] == b'\n\n':
+            end -= 1
+        elif end - start >= 4 and mbox[end - 4:end] == b'\r\n\r\n':
+            end -= 2
+        yield start, end
+
+
+def index_path(basedir, filename):
+    """Returns the path of the Message-Id index of an mbox
+
+    Indexes are kept in MSGID_INDEX_DIR rather than next to the mbox files,
+    a Thunderbird profile would show any extra file there as a folder.
+    """
+    return os.path.join(basedir, MSGID_INDEX_DIR, filename + MSGID_INDEX_SUFFIX)
+
+
+def index_stamp(fullname):
+    """Returns the index header line for the current size and mtime of an mbox"""
+    st = os.stat(fullname)
+    return MSGID_INDEX_HEADER % (st.st_size, st.st_mtime_ns)
+
+
+def index_is_current(basedir, filename):
+    """Returns True if the Message-Id index of an mbox describes the mbox as it is now
+
+    The index records the size and mtime of the mbox, an mbox that was
+    appended to, replaced or restored with its old mtime does not match.
+    """
+    try:
+        with open(index_path(basedir, filename), 'r', encoding='utf-8',
+                  errors='surrogateescape', newline='\n') as f:
+            return f.readline() == index_stamp(os.path.join(basedir, filename))
+    except (IOError, OSError):
+        return False
+
+
+def read_index(basedir, filename):
+    """Returns the Message-Ids listed in the index of an mbox, or None if it is missing or stale"""
+    try:
+        with open(index_path(basedir, filename), 'r', encoding='utf-8',
+                  errors='surrogateescape', newline='\n') as f:
+            if f.readline() != index_stamp(os.path.join(basedir, filename)):
+                return None
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    messages = {}
+    for msg_id in data.split('\n'):
+        if msg_id:
+            messages[msg_id] = msg_id
+    return messages
+
+
+def write_index(basedir, filename, msg_ids, append=False):
+    """Writes (or appends) Message-Ids to the index of an mbox, one per line
+
+    The header is rewritten to the current size and mtime of the mbox, so
+    it must be called after the mbox is closed. On failure the index is
+    removed, so the next scan_file reads the mbox.
+    """
+    index = index_path(basedir, filename)
+    try:
+        stamp = index_stamp(os.path.join(basedir, filename))
+        lines = ''.join(msg_id + '\n' for msg_id in msg_ids)
+        if append:
+            # the header has a fixed width, it is replaced in place
+            with open(index, 'r+', encoding='utf-8',
+                      errors='surrogateescape', newline='\n') as f:
+                f.write(stamp)
+                f.seek(0, os.SEEK_END)
+                f.write(lines)
+        else:
+            os.makedirs(os.path.dirname(index), exist_ok=True)
+            with open(index, 'w', encoding='utf-8',
+                      errors='surrogateescape', newline='\n') as f:
+                f.write(stamp + lines)
+    except (IOError, OSError) as e:
+        print ("\nWARNING: Cannot write index %s: %s" % (index, str(e)))
+        remove_index(basedir, filename)
+
+
+def remove_index(basedir, filename):
+    """Removes the Message-Id index of an mbox, if there is one"""
+    try:
+        os.remove(index_path(basedir, filename))
+    except OSError:
+        pass
+
+
 def scan_file(filename, overwrite, nospinner, basedir):
     """Gets IDs of messages in the specified mbox file
 
+    The mbox is only parsed when its Message-Id index is missing or does
+    not match the size and mtime of the mbox, the index is rewritten afterwards.
+
     Returns:
         dict: Dictionary of message IDs found in file, or empty dict on error
     """
@@ -850,20 +1432,28 @@ def scan_file(filename, overwrite, nospinner, basedir):
         print ("File %s: not found" % filename)
         return {}
 
+    messages = read_index(basedir, filename)
+    if messages is not None:
+        print ("File %s: %d messages (from index)" % (filename, len(messages)))
+        return messages
+
     spinner = Spinner("File %s" % filename, nospinner)
     messages = {}
 
     try:
-        # open the mailbox file for read
+        # map the mailbox file for read, only headers are parsed
         try:
-            mbox = mailbox.mbox(fullname)
+            mbox_file = open(fullname, 'rb')
         except (IOError, OSError) as e:
             spinner.stop()
             print ("\nERROR: Cannot open mbox file %s: %s" % (fullname, str(e)))
             return {}
-        except Exception as e:
+        try:
+            mbox = map_file(mbox_file)
+        except (IOError, OSError, ValueError) as e:
+            mbox_file.close()
             spinner.stop()
-            print ("\nERROR: Mailbox file %s is corrupted or invalid: %s" % (fullname, str(e)))
+            print ("\nERROR: Cannot map mbox file %s: %s" % (fullname, str(e)))
             return {}
 
         # each message
@@ -871,31 +1461,23 @@ def scan_file(filename, overwrite, nospinner, basedir):
         HEADER_MESSAGE_ID='Message-Id'
 
         try:
-            for message in mbox:
+            for header_block in iter_mbox_headers(mbox):
                 try:
-                    header = ''
                     # We assume all messages on disk have message-ids
-                    try:
-                        header = "{0}: {1}".format(HEADER_MESSAGE_ID,message.get(HEADER_MESSAGE_ID))
-                    except KeyError:
+                    value = header_value(header_block, HEADER_MESSAGE_ID)
+                    if value is None:
                         # No message ID was found. Warn the user and move on
                         print ("\nWARNING: Message #%d in %s has no {0} header.".format(HEADER_MESSAGE_ID) % (i, filename))
                         i += 1
                         spinner.spin()
                         continue
-                    except Exception as e:
-                        print ("\nWARNING: Cannot read headers from message #%d in %s: %s" % (i, filename, str(e)))
-                        i += 1
-                        spinner.spin()
-                        continue
 
-                    header = BLANKS_RE.sub(' ', header.strip())
-                    try:
-                        msg_id = MSGID_RE.match(header).group(1)
-                        if msg_id not in messages.keys():
+                    msg_id = message_id_from_header("{0}: {1}".format(HEADER_MESSAGE_ID, value))
+                    if msg_id is not None:
+                        if msg_id not in messages:
                             # avoid adding dupes
                             messages[msg_id] = msg_id
-                    except (AttributeError, IndexError):
+                    else:
                         # Message-Id was found but could somehow not be parsed by regexp
                         print ("\nWARNING: Message #%d in %s has a malformed {0} header.".format(HEADER_MESSAGE_ID) % (i, filename))
 
@@ -912,19 +1494,25 @@ def scan_file(filename, overwrite, nospinner, basedir):
             print ("\nERROR: Failed while reading mailbox %s: %s" % (filename, str(e)))
             print ("Recovered %d messages before error" % len(messages))
             try:
-                mbox.close()
+                if mbox:
+                    mbox.close()
+                mbox_file.close()
             except:
                 pass
             return messages
 
         # done
         try:
-            mbox.close()
+            if mbox:
+                mbox.close()
+            mbox_file.close()
         except Exception as e:
             print ("\nWARNING: Error closing mbox file %s: %s" % (filename, str(e)))
 
+        write_index(basedir, filename, messages)
+
         spinner.stop()
-        print (": %d messages" % (len(messages.keys())))
+        print (": %d messages" % (len(messages)))
         return messages
 
     except Exception as e:
@@ -933,6 +1521,160 @@ def scan_file(filename, overwrite, nospinner, basedir):
         return {}
 
 
+def compress_sequence_set(nums):
+    """Builds a compact IMAP sequence set from message numbers, eg: [1,2,3,7] -> '1:3,7'"""
+    ranges = []
+    start = prev = None
+    for num in sorted(nums):
+        if prev is not None and num == prev + 1:
+            prev = num
+            continue
+        if start is not None:
+            ranges.append('%d:%d' % (start, prev) if start != prev else '%d' % start)
+        start = prev = num
+    if start is not None:
+        ranges.append('%d:%d' % (start, prev) if start != prev else '%d' % start)
+    return ','.join(ranges)
+
+
+def message_digest(header):
+    """Returns the SHA-1 hex digest used in synthesised Message-Ids
+
+    The digest only identifies messages, so it is computed with
+    usedforsecurity=False where supported, which keeps it available
+    on FIPS-restricted OpenSSL builds. It must stay SHA-1, changing it
+    would change the ids of messages already in existing backups.
+    """
+    if sys.version_info >= (3, 9):
+        return hashlib.sha1(header, usedforsecurity=False).hexdigest()
+    return hashlib.sha1(header).hexdigest()
+
+
+def synthesize_message_ids(server, foldername_quoted, nums, messages):
+    """Generates Message-Ids for messages that lack one, using one FETCH per batch
+
+    The synthesised id is a hash of the From/To/Cc/Date/Subject headers, so the
+    same message always gets the same id across runs. Results are added to the
+    messages dict (id -> message number).
+    """
+    msg_set = compress_sequence_set(nums)
+    try:
+        def fetch_headers_operation():
+            return server.fetch(msg_set, '(BODY.PEEK[HEADER.FIELDS (FROM TO CC DATE SUBJECT)])')
+
+        typ, data = retry_on_network_error(
+            fetch_headers_operation,
+            operation_name="Fetch headers %s from %s" % (msg_set, foldername_quoted)
+        )
+    except (imaplib.IMAP4.error, socket.error, socket.timeout) as e:
+        print ("\nWARNING: Cannot fetch headers for %d messages in %s after retries: %s" % (len(nums), foldername_quoted, str(e)))
+        return
+    except Exception as e:
+        print ("\nWARNING: Unexpected error fetching headers from %s: %s" % (foldername_quoted, str(e)))
+        return
+
+    if 'OK' != typ:
+        print ("\nWARNING: FETCH of headers failed for %s: %s" % (foldername_quoted, data))
+        return
+
+    # Each message comes back as a (b'<num> (BODY[...] {n}', header) tuple
+    for item in data:
+        if not isinstance(item, tuple):
+            continue
+        match = FETCH_NUM_RE.match(item[0])
+        if not match:
+            continue
+        num = int(match.group(1))
+        try:
+            data_str = str(item[1], 'utf-8', 'replace')
+            header = data_str.strip()
+            header = header.replace('\r\n', '\t').encode('utf-8')
+            messages['<' + UUID + '.' +
+                     message_digest(header) + '>'] = num
+        except Exception as e:
+            print ("\nWARNING: Cannot generate message ID for message %d: %s" % (num, str(e)))
+
+
+def fetch_aligned(data, start):
+    """Returns True if a FETCH response starts with message number start"""
+    item = data[0] if data else None
+    if not isinstance(item, tuple):
+        return False
+    match = FETCH_NUM_RE.match(item[0])
+    return match is not None and int(match.group(1)) == start
+
+
+def fetch_header_batches(server, foldername_quoted, batches):
+    """Yields (start, end, data) for a Message-Id FETCH of each (start, end) batch
+
+    On imaplib connections up to SCAN_PIPELINE_DEPTH FETCH commands are kept
+    in flight, so the server does not sit idle for a round-trip between
+    batches. A server may run pipelined commands concurrently; if a response
+    does not start at its batch, the remaining batches are fetched one at a
+    time. Mocked servers and single batches use plain fetch() calls.
+
+    Raises:
+        SkipFolderException: When a FETCH fails
+    """
+    fetch_cmd = '(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])'
+    batches = collections.deque(batches)
+    in_flight = collections.deque()
+    pipeline = isinstance(server, imaplib.IMAP4) and len(batches) > 1
+
+    while batches or in_flight:
+        if not pipeline:
+            batch_start, batch_end = batches.popleft()
+            batch_range = '%d:%d' % (batch_start, batch_end)
+
+            # Fetch headers for this batch
+            # The result is an array of result tuples with a terminating closing parenthesis
+            # after each tuple. That means that the first result is at index 0, the second at
+            # 2, third at 4, and so on.
+            try:
+                def fetch_headers_operation():
+                    return server.fetch(batch_range, fetch_cmd)
+
+                typ, data = retry_on_network_error(
+                    fetch_headers_operation,
+                    operation_name="Fetch headers %s from %s" % (batch_range, foldername_quoted)
+                )
+            except (imaplib.IMAP4.error, socket.error, socket.timeout) as e:
+                raise SkipFolderException("FETCH failed for %s after retries: %s" % (foldername_quoted, str(e)))
+            except Exception as e:
+                raise SkipFolderException("Unexpected error fetching headers from %s: %s" % (foldername_quoted, str(e)))
+
+            if 'OK' != typ:
+                raise SkipFolderException("FETCH failed: %s" % (data))
+            yield batch_start, batch_end, data
+            continue
+
+        try:
+            while batches and len(in_flight) < SCAN_PIPELINE_DEPTH:
+                batch_start, batch_end = batches.popleft()
+                tag = server._command('FETCH', '%d:%d' % (batch_start, batch_end), fetch_cmd)
+                in_flight.append((batch_start, batch_end, tag))
+            batch_start, batch_end, tag = in_flight.popleft()
+            typ, data = server._command_complete('FETCH', tag)
+            typ, data = server._untagged_response(typ, data, 'FETCH')
+
+            if 'OK' == typ and not fetch_aligned(data, batch_start):
+                # read the rest of the responses and start over without pipelining
+                for _, _, tag in in_flight:
+                    server._command_complete('FETCH', tag)
+                server._untagged_response('OK', [None], 'FETCH')
+                batches.extendleft(reversed([(batch_start, batch_end)] +
+                                            [(start, end) for start, end, _ in in_flight]))
+                in_flight.clear()
+                pipeline = False
+                continue
+        except (imaplib.IMAP4.error, socket.error, socket.timeout) as e:
+            raise SkipFolderException("FETCH failed for %s: %s" % (foldername_quoted, str(e)))
+
+        if 'OK' != typ:
+            raise SkipFolderException("FETCH failed: %s" % (data))
+        yield batch_start, batch_end, data
+
+
 def scan_folder(server, foldername, nospinner):
     """Gets IDs of messages in the specified folder, returns id:num dict
 
@@ -974,87 +1716,42 @@ def scan_folder(server, foldername, nospinner):
 
         # Retrieve Message-Id headers in batches to avoid memory issues with large mailboxes
         # Process messages in batches of FETCH_BATCH_SIZE to keep memory usage constant
-        if num_msgs > 0:
-            # Process messages in batches
-            for batch_start in range(1, num_msgs + 1, FETCH_BATCH_SIZE):
-                batch_end = min(batch_start + FETCH_BATCH_SIZE - 1, num_msgs)
-                batch_range = '%d:%d' % (batch_start, batch_end)
-
-                # Fetch headers for this batch
-                # The result is an array of result tuples with a terminating closing parenthesis
-                # after each tuple. That means that the first result is at index 0, the second at
-                # 2, third at 4, and so on.
-                try:
-                    def fetch_headers_operation():
-                        return server.fetch(batch_range, '(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
-
-                    typ, data = retry_on_network_error(
-                        fetch_headers_operation,
-                        operation_name="Fetch headers %s from %s" % (batch_range, foldername_quoted)
-                    )
-                except (imaplib.IMAP4.error, socket.error, socket.timeout) as e:
-                    spinner.stop()
-                    raise SkipFolderException("FETCH failed for %s after retries: %s" % (foldername_quoted, str(e)))
-                except Exception as e:
-                    spinner.stop()
-                    raise SkipFolderException("Unexpected error fetching headers from %s: %s" % (foldername_quoted, str(e)))
+        batches = [(batch_start, min(batch_start + FETCH_BATCH_SIZE - 1, num_msgs))
+                   for batch_start in range(1, num_msgs + 1, FETCH_BATCH_SIZE)]
+        missing = []  # Per batch lists of message numbers without a usable Message-Id
+        for batch_start, batch_end, data in fetch_header_batches(server, foldername_quoted, batches):
+            # Process each message in this batch
+            batch_missing = []
+            batch_size = batch_end - batch_start + 1
+            for i in range(0, batch_size):
+                num = batch_start + i
+                spinner.update(current=num)
 
-                if 'OK' != typ:
-                    spinner.stop()
-                    raise SkipFolderException("FETCH failed: %s" % (data))
-
-                # Process each message in this batch
-                batch_size = batch_end - batch_start + 1
-                for i in range(0, batch_size):
-                    num = batch_start + i
-                    spinner.update(current=num)
-
-                    try:
-                        # Double the index because of the terminating parenthesis after each tuple.
-                        data_str = str(data[2 * i][1], 'utf-8', 'replace')
-                        header = data_str.strip()
+                try:
+                    # Double the index because of the terminating parenthesis after each tuple.
+                    data_str = str(data[2 * i][1], 'utf-8', 'replace')
+                    msg_id = message_id_from_header(data_str)
+                    if msg_id is not None:
+                        if msg_id not in messages:
+                            # avoid adding dupes
+                            messages[msg_id] = num
+                    else:
+                        # Some messages may have no Message-Id, so we'll synthesise one
+                        # (this usually happens with Sent, Drafts and .Mac news).
+                        # Collect them here and fetch their headers once per batch below.
+                        batch_missing.append(num)
 
-                        # remove newlines inside Message-Id (a dumb Exchange trait)
-                        header = BLANKS_RE.sub(' ', header)
-                        try:
-                            msg_id = MSGID_RE.match(header).group(1)
-                            if msg_id not in messages.keys():
-                                # avoid adding dupes
-                                messages[msg_id] = num
-                        except (IndexError, AttributeError):
-                            # Some messages may have no Message-Id, so we'll synthesise one
-                            # (this usually happens with Sent, Drafts and .Mac news)
-                            try:
-                                msg_typ, msg_data = server.fetch(
-                                    str(num), '(BODY[HEADER.FIELDS (FROM TO CC DATE SUBJECT)])')
-                            except (imaplib.IMAP4.error, socket.error, socket.timeout) as e:
-                                print ("\nWARNING: Cannot fetch headers for message %d: %s" % (num, str(e)))
-                                continue
-                            except Exception as e:
-                                print ("\nWARNING: Unexpected error fetching message %d: %s" % (num, str(e)))
-                                continue
-
-                            if 'OK' != msg_typ:
-                                print ("\nWARNING: FETCH %d failed: %s" % (num, msg_data))
-                                continue
+                except (IndexError, KeyError, TypeError) as e:
+                    print ("\nWARNING: Cannot process message %d in %s: %s" % (num, foldername_quoted, str(e)))
+                except Exception as e:
+                    print ("\nWARNING: Unexpected error processing message %d: %s" % (num, str(e)))
 
-                            try:
-                                data_str = str(msg_data[0][1], 'utf-8', 'replace')
-                                header = data_str.strip()
-                                header = header.replace('\r\n', '\t').encode('utf-8')
-                                messages['<' + UUID + '.' +
-                                         hashlib.sha1(header).hexdigest() + '>'] = num
-                            except Exception as e:
-                                print ("\nWARNING: Cannot generate message ID for message %d: %s" % (num, str(e)))
-
-                    except (IndexError, KeyError, TypeError) as e:
-                        print ("\nWARNING: Cannot process message %d in %s: %s" % (num, foldername_quoted, str(e)))
-                    except Exception as e:
-                        print ("\nWARNING: Unexpected error processing message %d: %s" % (num, str(e)))
+            if batch_missing:
+                missing.append(batch_missing)
 
-                # Free up memory from this batch before processing the next one
-                del data
-                gc.collect()
+        # no FETCH may be sent while pipelined batches are still in flight
+        for batch_missing in missing:
+            synthesize_message_ids(server, foldername_quoted, batch_missing, messages)
 
     except SkipFolderException:
         # Re-raise SkipFolderException to allow caller to continue with next folder
@@ -1070,56 +1767,53 @@ def scan_folder(server, foldername, nospinner):
         print (":",)
 
     # done
-    print ("%d messages" % (len(messages.keys())))
+    print ("%d messages" % (len(messages)))
     return messages
 
 
-def parse_paren_list(row):
-    """Parses the nested list of attributes at the start of a LIST response"""
+def parse_paren_list(row, i=0):
+    """Parses the nested list of attributes at the start of a LIST response
+
+    Returns the list and the index in row just past its closing paren.
+    """
     # eat starting paren
-    assert(row[0] == '(')
-    row = row[1:]
+    assert(row[i] == '(')
+    i += 1
 
     result = []
 
-    # NOTE: RFC3501 doesn't fully define the format of name attributes
-    name_attrib_re = re.compile(r"^\s*(\\[a-zA-Z0-9_]+)\s*")
-
     # eat name attributes until ending paren
-    while row[0] != ')':
+    while row[i] != ')':
         # recurse
-        if row[0] == '(':
-            paren_list, row = parse_paren_list(row)
+        if row[i] == '(':
+            paren_list, i = parse_paren_list(row, i)
             result.append(paren_list)
         # consume name attribute
         else:
-            match = name_attrib_re.search(row)
+            match = NAME_ATTRIB_RE.match(row, i)
             assert(match is not None)
-            name_attrib = row[match.start():match.end()]
-            row = row[match.end():]
-            name_attrib = name_attrib.strip()
-            result.append(name_attrib)
+            result.append(match.group(1))
+            i = match.end()
 
     # eat ending paren
-    assert(')' == row[0])
-    row = row[1:]
+    assert(')' == row[i])
+    i += 1
 
     # done!
-    return result, row
+    return result, i
 
 
-def parse_string_list(row):
+def parse_string_list(row, i=0):
     """Parses the quoted and unquoted strings at the end of a LIST response"""
-    slist = re.compile(r'\s*"([^"]+)"\s*|\s*(\S+)\s*').split(row)
-    return [s for s in slist if s]
+    return [match.group(1) or match.group(2)
+            for match in STRING_LIST_RE.finditer(row, i)]
 
 
 def parse_list(row):
     """Parses response of LIST command into a list"""
     row = row.strip()
-    print(row)
-    paren_list, row = parse_paren_list(row)
-    string_list = parse_string_list(row)
+    paren_list, i = parse_paren_list(row)
+    string_list = parse_string_list(row, i)
     assert(len(string_list) == 2)
     return [paren_list] + string_list
 
@@ -1164,9 +1858,14 @@ def load_config_file(config_file):
         print ("Install with: pip install pyyaml")
         sys.exit(2)
 
+    import yaml
+    # the libyaml based loader is much faster, it is missing when PyYAML
+    # was built without libyaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
     try:
         with open(config_file, 'r') as f:
-            config_data = yaml.safe_load(f)
+            config_data = yaml.load(f, Loader=loader)
 
         if not config_data or 'accounts' not in config_data:
             print ("ERROR: Invalid config file. Must contain 'accounts' section.")
@@ -1185,6 +1884,12 @@ def load_config_file(config_file):
         sys.exit(2)
 
 
+# Defaults of the s3 and gpg sections of a config file
+S3_DEFAULTS = {'enabled': False, 'endpoint': '', 'bucket': '', 'access_key': '',
+               'secret_key': '', 'prefix': 'backups'}
+GPG_DEFAULTS = {'enabled': False, 'recipient': '', 'import_key': ''}
+
+
 def parse_account_config(account, global_config, date_override=None):
     """Parse a single account configuration, merging with global settings
 
@@ -1239,6 +1944,7 @@ def parse_account_config(account, global_config, date_override=None):
 
     # Check if date-based folders are enabled
     use_date_folders = account.get('use_date_folders', global_config.get('use_date_folders', False))
+    date_str = None
 
     if use_date_folders or date_override:
         # Get date format (default: YYYY-MM-DD)
@@ -1263,6 +1969,15 @@ def parse_account_config(account, global_config, date_override=None):
     # Spinner setting
     config['nospinner'] = account.get('nospinner', global_config.get('nospinner', False))
 
+    # Number of folders processed in parallel, each over its own connection
+    try:
+        config['folder_workers'] = int(account.get('folder_workers', global_config.get('folder_workers', 1)))
+        if config['folder_workers'] <= 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        print ("ERROR: Invalid folder_workers value for account '%s'. Must be an integer greater than 0." % account_name)
+        sys.exit(2)
+
     # Thunderbird and iCloud settings
     config['thunderbird'] = account.get('thunderbird', global_config.get('thunderbird', False))
     config['icloud'] = account.get('icloud', global_config.get('icloud', False))
@@ -1271,21 +1986,20 @@ def parse_account_config(account, global_config, date_override=None):
     config['restore'] = False
     config['overwrite'] = False
 
-    # S3 configuration
-    s3_config = {}
-    global_s3 = global_config.get('s3', {})
-    account_s3 = account.get('s3', {})
+    # S3 configuration, account settings override global ones
+    account_s3 = account.get('s3') or {}
+    global_s3 = global_config.get('s3') or {}
+    s3 = collections.ChainMap(account_s3, global_s3, S3_DEFAULTS)
 
     # Check if S3 is enabled for this account
-    s3_enabled = account.get('s3_enabled', account_s3.get('enabled', global_s3.get('enabled', False)))
+    s3_enabled = account.get('s3_enabled', s3['enabled'])
     config['s3_upload'] = s3_enabled
 
     if s3_enabled:
-        # Merge S3 settings (account overrides global)
-        config['s3_endpoint'] = account_s3.get('endpoint', global_s3.get('endpoint', ''))
-        config['s3_bucket'] = account_s3.get('bucket', global_s3.get('bucket', ''))
-        config['s3_access_key'] = account_s3.get('access_key', global_s3.get('access_key', ''))
-        config['s3_secret_key'] = account_s3.get('secret_key', global_s3.get('secret_key', ''))
+        config['s3_endpoint'] = s3['endpoint']
+        config['s3_bucket'] = s3['bucket']
+        config['s3_access_key'] = s3['access_key']
+        config['s3_secret_key'] = s3['secret_key']
 
         # S3 prefix: use custom or build from global prefix + account name (+ date if enabled)
         if 's3_prefix' in account:
@@ -1293,107 +2007,147 @@ def parse_account_config(account, global_config, date_override=None):
         elif 's3_prefix' in account_s3:
             config['s3_prefix'] = account_s3['prefix']
         else:
-            global_prefix = global_s3.get('prefix', 'backups')
-            if use_date_folders or date_override:
-                # Include date in S3 prefix: prefix/account_name/{date}
-                date_format = account.get('date_format', global_config.get('date_format', '%Y-%m-%d'))
-                # Use override date if provided, otherwise use current date
-                if date_override:
-                    date_str = date_override
-                else:
-                    date_str = time.strftime(date_format)
+            global_prefix = global_s3.get('prefix', S3_DEFAULTS['prefix'])
+            if date_str:
+                # Include date in S3 prefix: prefix/account_name/{date}, the same
+                # date as the local folder even if the clock passed midnight
                 config['s3_prefix'] = '%s/%s/%s' % (global_prefix.rstrip('/'), account_name, date_str)
             else:
                 # Standard prefix: prefix/account_name
                 config['s3_prefix'] = '%s/%s' % (global_prefix.rstrip('/'), account_name)
 
-    # GPG configuration
-    global_gpg = global_config.get('gpg', {})
-    account_gpg = account.get('gpg', {})
+    # GPG configuration, account settings override global ones
+    gpg = collections.ChainMap(account.get('gpg') or {}, global_config.get('gpg') or {}, GPG_DEFAULTS)
 
     # Check if GPG is enabled for this account
-    gpg_enabled = account.get('gpg_enabled', account_gpg.get('enabled', global_gpg.get('enabled', False)))
+    gpg_enabled = account.get('gpg_enabled', gpg['enabled'])
     config['gpg_encrypt'] = gpg_enabled
 
     if gpg_enabled:
-        # Merge GPG settings (account overrides global)
-        config['gpg_recipient'] = account_gpg.get('recipient', global_gpg.get('recipient', ''))
-        import_key = account_gpg.get('import_key', global_gpg.get('import_key', ''))
+        config['gpg_recipient'] = gpg['recipient']
+        import_key = gpg['import_key']
         if import_key:
             config['gpg_import_key'] = import_key
 
     return config
 
 
+USAGE = """\
+Usage: imapbackup [OPTIONS] -s HOST -u USERNAME [-p PASSWORD]
+   or: imapbackup --config=CONFIG_FILE [--restore]
+   or: imapbackup
+
+Config File Mode:
+ --config=FILE                 Load settings from YAML config file.
+                               Allows backing up multiple accounts.
+                               See config.example.yaml for format.
+
+ Auto-detection:               If no arguments are provided, the script
+                               automatically looks for 'config.yaml' or
+                               'config.yml' in the current directory.
+
+ --restore                     Restore mode (use with --config).
+ --account=NAME                Filter to specific account(s). Can be comma-separated
+                               or specified multiple times.
+                               Example: --account=gmail,work
+ --date=DATE                   Override date for restore. Useful for restoring
+                               from a specific date-based backup folder.
+                               Example: --date=2025-10-10
+ --list                        List all available backups (local and S3).
+                               Can be combined with --account to filter.
+ --account-workers=N           Process N accounts in parallel. Disables the
+                               spinner. Overrides account_workers. (default 1)
+
+Command Line Mode:
+ -d DIR --mbox-dir=DIR         Write mbox files to directory. (defaults to cwd)
+ -a --append-to-mboxes         Append new messages to mbox files. (default)
+ -y --yes-overwrite-mboxes     Overwite existing mbox files instead of appending.
+ -r --restore                  Restore mode: upload mbox files to IMAP server.
+                               Will not upload messages that already exist on server.
+ -f FOLDERS --folders=FOLDERS  Specify which folders to include. Comma separated list.
+ --exclude-folders=FOLDERS     Specify which folders to exclude. Comma separated list.
+                               You cannot use both --folders and --exclude-folders.
+ -e --ssl                      Use SSL.  Port defaults to 993.
+ -k KEY --key=KEY              PEM private key file for SSL.  Specify cert, too.
+ -c CERT --cert=CERT           PEM certificate chain for SSL.  Specify key, too.
+                               Python's SSL module doesn't check the cert chain.
+ -s HOST --server=HOST         Address of server, port optional, eg. mail.com:143
+ -u USER --user=USER           Username to log into server
+ -p PASS --pass=PASS           Prompts for password if not specified.  If the first
+                               character is '@', treat the rest as a path to a file
+                               containing the password.  Leading '\\' makes it literal.
+ -t SECS --timeout=SECS        Sets socket timeout to SECS seconds.
+ --thunderbird                 Create Mozilla Thunderbird compatible mailbox
+ --nospinner                   Disable spinner (makes output log-friendly)
+ --icloud                      Enable iCloud compatibility mode (for iCloud mailserver)
+ --folder-workers=N            Process N folders in parallel, each over its own
+                               connection. Disables the spinner. (default 1)
+                               Overrides folder_workers from --config.
+
+S3 Storage Options:
+ --s3-upload                   Enable S3 storage integration
+                               Backup mode: Upload mbox files to S3 after backup
+                               Restore mode: Download mbox files from S3 before restore
+ --s3-endpoint=URL             S3 endpoint URL (e.g., https://s3.eu-central-1.wasabisys.com)
+ --s3-bucket=BUCKET            S3 bucket name
+ --s3-access-key=KEY           S3 access key ID
+ --s3-secret-key=KEY           S3 secret access key
+ --s3-prefix=PREFIX            Optional prefix for S3 object keys (e.g., backups/imap/)
+ --gpg-encrypt                 Encrypt/decrypt files with GPG when using S3
+                               Backup mode: Encrypts before upload
+                               Restore mode: Decrypts after download
+ --gpg-recipient=EMAIL         GPG recipient email/key ID (required for encryption)
+ --gpg-import-key=SOURCE       Import GPG public key before encryption. SOURCE can be:
+                               - File path: /path/to/key.asc or ~/keys/public.asc
+                               - URL: https://example.com/public-key.asc
+                               - Environment variable: env:GPG_PUBLIC_KEY
+"""
+
+
 def print_usage():
     """Prints usage, exits"""
-    #     "                                                                               "
-    print ("Usage: imapbackup [OPTIONS] -s HOST -u USERNAME [-p PASSWORD]")
-    print ("   or: imapbackup --config=CONFIG_FILE [--restore]")
-    print ("   or: imapbackup")
-    print ("")
-    print ("Config File Mode:")
-    print (" --config=FILE                 Load settings from YAML config file.")
-    print ("                               Allows backing up multiple accounts.")
-    print ("                               See config.example.yaml for format.")
-    print ("")
-    print (" Auto-detection:               If no arguments are provided, the script")
-    print ("                               automatically looks for 'config.yaml' or")
-    print ("                               'config.yml' in the current directory.")
-    print ("")
-    print (" --restore                     Restore mode (use with --config).")
-    print (" --account=NAME                Filter to specific account(s). Can be comma-separated")
-    print ("                               or specified multiple times.")
-    print ("                               Example: --account=gmail,work")
-    print (" --date=DATE                   Override date for restore. Useful for restoring")
-    print ("                               from a specific date-based backup folder.")
-    print ("                               Example: --date=2025-10-10")
-    print (" --list                        List all available backups (local and S3).")
-    print ("                               Can be combined with --account to filter.")
-    print ("")
-    print ("Command Line Mode:")
-    print (" -d DIR --mbox-dir=DIR         Write mbox files to directory. (defaults to cwd)")
-    print (" -a --append-to-mboxes         Append new messages to mbox files. (default)")
-    print (" -y --yes-overwrite-mboxes     Overwite existing mbox files instead of appending.")
-    print (" -r --restore                  Restore mode: upload mbox files to IMAP server.")
-    print ("                               Will not upload messages that already exist on server.")
-    print (" -f FOLDERS --folders=FOLDERS  Specify which folders to include. Comma separated list.")
-    print (" --exclude-folders=FOLDERS     Specify which folders to exclude. Comma separated list.")
-    print ("                               You cannot use both --folders and --exclude-folders.")
-    print (" -e --ssl                      Use SSL.  Port defaults to 993.")
-    print (" -k KEY --key=KEY              PEM private key file for SSL.  Specify cert, too.")
-    print (" -c CERT --cert=CERT           PEM certificate chain for SSL.  Specify key, too.")
-    print ("                               Python's SSL module doesn't check the cert chain.")
-    print (" -s HOST --server=HOST         Address of server, port optional, eg. mail.com:143")
-    print (" -u USER --user=USER           Username to log into server")
-    print (" -p PASS --pass=PASS           Prompts for password if not specified.  If the first")
-    print ("                               character is '@', treat the rest as a path to a file")
-    print ("                               containing the password.  Leading '\' makes it literal.")
-    print (" -t SECS --timeout=SECS        Sets socket timeout to SECS seconds.")
-    print (" --thunderbird                 Create Mozilla Thunderbird compatible mailbox")
-    print (" --nospinner                   Disable spinner (makes output log-friendly)")
-    print (" --icloud                      Enable iCloud compatibility mode (for iCloud mailserver)")
-    print ("")
-    print ("S3 Storage Options:")
-    print (" --s3-upload                   Enable S3 storage integration")
-    print ("                               Backup mode: Upload mbox files to S3 after backup")
-    print ("                               Restore mode: Download mbox files from S3 before restore")
-    print (" --s3-endpoint=URL             S3 endpoint URL (e.g., https://s3.eu-central-1.wasabisys.com)")
-    print (" --s3-bucket=BUCKET            S3 bucket name")
-    print (" --s3-access-key=KEY           S3 access key ID")
-    print (" --s3-secret-key=KEY           S3 secret access key")
-    print (" --s3-prefix=PREFIX            Optional prefix for S3 object keys (e.g., backups/imap/)")
-    print (" --gpg-encrypt                 Encrypt/decrypt files with GPG when using S3")
-    print ("                               Backup mode: Encrypts before upload")
-    print ("                               Restore mode: Decrypts after download")
-    print (" --gpg-recipient=EMAIL         GPG recipient email/key ID (required for encryption)")
-    print (" --gpg-import-key=SOURCE       Import GPG public key before encryption. SOURCE can be:")
-    print ("                               - File path: /path/to/key.asc or ~/keys/public.asc")
-    print ("                               - URL: https://example.com/public-key.asc")
-    print ("                               - Environment variable: env:GPG_PUBLIC_KEY")
+    sys.stdout.write(USAGE)
     sys.exit(2)
 
 
+# Command line options that store their value, option -> config key
+VALUE_OPTIONS = {
+    "-d": 'basedir', "--mbox-dir": 'basedir',
+    "-k": 'keyfilename', "--keyfile": 'keyfilename',
+    "-f": 'folders', "--folders": 'folders',
+    "--exclude-folders": 'exclude-folders',
+    "-c": 'certfilename', "--certfile": 'certfilename',
+    "-s": 'server', "--server": 'server',
+    "-u": 'user', "--user": 'user',
+    "-t": 'timeout', "--timeout": 'timeout',
+    "--folder-workers": 'folder_workers',
+    "--s3-endpoint": 's3_endpoint',
+    "--s3-bucket": 's3_bucket',
+    "--s3-access-key": 's3_access_key',
+    "--s3-secret-key": 's3_secret_key',
+    "--s3-prefix": 's3_prefix',
+    "--gpg-recipient": 'gpg_recipient',
+    "--gpg-import-key": 'gpg_import_key',
+    "--config": 'config_file',
+    "--date": 'date_override',
+    "--account-workers": 'account_workers',
+}
+
+# Command line flags, option -> (config key, value)
+FLAG_OPTIONS = {
+    "-a": ('overwrite', False), "--append-to-mboxes": ('overwrite', False),
+    "-y": ('overwrite', True), "--yes-overwrite-mboxes": ('overwrite', True),
+    "-r": ('restore', True), "--restore": ('restore', True),
+    "-e": ('usessl', True), "--ssl": ('usessl', True),
+    "--thunderbird": ('thunderbird', True),
+    "--nospinner": ('nospinner', True),
+    "--icloud": ('icloud', True),
+    "--s3-upload": ('s3_upload', True),
+    "--gpg-encrypt": ('gpg_encrypt', True),
+    "--list": ('list_backups', True),
+}
+
+
 def process_cline():
     """Uses getopt to process command line, returns (config, warnings, errors)"""
     # read command line
@@ -1404,7 +2158,7 @@ def process_cline():
                      "folders=", "exclude-folders=", "thunderbird", "nospinner", "mbox-dir=", "icloud",
                      "s3-upload", "s3-endpoint=", "s3-bucket=", "s3-access-key=", "s3-secret-key=",
                      "s3-prefix=", "gpg-encrypt", "gpg-recipient=", "gpg-import-key=", "config=",
-                     "account=", "date=", "list"]
+                     "account=", "date=", "list", "folder-workers=", "account-workers="]
         opts, extraargs = getopt.getopt(sys.argv[1:], short_args, long_args)
     except getopt.GetoptError:
         print_usage()
@@ -1422,62 +2176,18 @@ def process_cline():
 
     # process each command line option, save in config
     for option, value in opts:
-        if option in ("-d", "--mbox-dir"):
-            config['basedir'] = value
-        elif option in ("-a", "--append-to-mboxes"):
-            config['overwrite'] = False
-        elif option in ("-y", "--yes-overwrite-mboxes"):
-            warnings.append("Existing mbox files will be overwritten!")
-            config["overwrite"] = True
-        elif option in ("-r", "--restore"):
-            config['restore'] = True
-        elif option in ("-e", "--ssl"):
-            config['usessl'] = True
-        elif option in ("-k", "--keyfile"):
-            config['keyfilename'] = value
-        elif option in ("-f", "--folders"):
-            config['folders'] = value
-        elif option in ("--exclude-folders"):
-            config['exclude-folders'] = value
-        elif option in ("-c", "--certfile"):
-            config['certfilename'] = value
-        elif option in ("-s", "--server"):
-            config['server'] = value
-        elif option in ("-u", "--user"):
-            config['user'] = value
+        if option in VALUE_OPTIONS:
+            config[VALUE_OPTIONS[option]] = value
+        elif option in FLAG_OPTIONS:
+            key, flag = FLAG_OPTIONS[option]
+            config[key] = flag
+            if option in ("-y", "--yes-overwrite-mboxes"):
+                warnings.append("Existing mbox files will be overwritten!")
         elif option in ("-p", "--pass"):
             try:
                 config['pass'] = string_from_file(value)
             except Exception as ex:
                 errors.append("Can't read password: %s" % (str(ex)))
-        elif option in ("-t", "--timeout"):
-            config['timeout'] = value
-        elif option == "--thunderbird":
-            config['thunderbird'] = True
-        elif option == "--nospinner":
-            config['nospinner'] = True
-        elif option == "--icloud":
-            config['icloud'] = True
-        elif option == "--s3-upload":
-            config['s3_upload'] = True
-        elif option == "--s3-endpoint":
-            config['s3_endpoint'] = value
-        elif option == "--s3-bucket":
-            config['s3_bucket'] = value
-        elif option == "--s3-access-key":
-            config['s3_access_key'] = value
-        elif option == "--s3-secret-key":
-            config['s3_secret_key'] = value
-        elif option == "--s3-prefix":
-            config['s3_prefix'] = value
-        elif option == "--gpg-encrypt":
-            config['gpg_encrypt'] = True
-        elif option == "--gpg-recipient":
-            config['gpg_recipient'] = value
-        elif option == "--gpg-import-key":
-            config['gpg_import_key'] = value
-        elif option == "--config":
-            config['config_file'] = value
         elif option == "--account":
             # Store as comma-separated list (can be specified multiple times)
             if 'account_filter' not in config:
@@ -1485,10 +2195,6 @@ def process_cline():
             # Split by comma and add all accounts
             accounts = [a.strip() for a in value.split(',') if a.strip()]
             config['account_filter'].extend(accounts)
-        elif option == "--date":
-            config['date_override'] = value
-        elif option == "--list":
-            config['list_backups'] = True
         else:
             errors.append("Unknown option: " + option)
 
@@ -1502,6 +2208,26 @@ def process_cline():
 
 def check_config(config, warnings, errors):
     """Checks the config for consistency, returns (config, warnings, errors)"""
+    # Applies to config file mode too, where it overrides the file
+    if 'folder_workers' in config:
+        try:
+            folder_workers = int(config['folder_workers'])
+            if folder_workers <= 0:
+                raise ValueError
+            config['folder_workers'] = folder_workers
+        except ValueError:
+            errors.append(
+                "Invalid folder workers value.  Must be an integer greater than 0.")
+    if 'account_workers' in config:
+        try:
+            account_workers = int(config['account_workers'])
+            if account_workers <= 0:
+                raise ValueError
+            config['account_workers'] = account_workers
+        except ValueError:
+            errors.append(
+                "Invalid account workers value.  Must be an integer greater than 0.")
+
     # Skip validation if using config file mode
     if 'config_file' in config:
         return config, warnings, errors
@@ -1610,18 +2336,19 @@ def get_config():
 
     # defaults (only for command-line mode)
     if 'config_file' not in config:
-        if 'port' not in config:
-            if config['usessl']:
-                config['port'] = 993
-            else:
-                config['port'] = 143
-        if 'timeout' not in config:
-            config['timeout'] = 60
+        set_connection_defaults(config)
 
     # done!
     return config
 
 
+def set_connection_defaults(config):
+    """Fills in the default port for the SSL setting and the default timeout"""
+    if 'port' not in config:
+        config['port'] = 993 if config.get('usessl', True) else 143
+    config.setdefault('timeout', 60)
+
+
 def connect_and_login(config):
     """Connects to the server and logs in with retry logic. Returns IMAP4 object."""
     assert(not (('keyfilename' in config) ^ ('certfilename' in config)))
@@ -1635,19 +2362,25 @@ def connect_and_login(config):
                 config['server'], config['port']),)
             print ("SSL, key from %s," % (config['keyfilename']),)
             print ("cert from %s " % (config['certfilename']))
-            server = imaplib.IMAP4_SSL(config['server'], config['port'],
-                                       config['keyfilename'], config['certfilename'])
+            server = IMAP4_SSL(config['server'], config['port'],
+                               config['keyfilename'], config['certfilename'])
         elif config['usessl']:
             print ("Connecting to '%s' TCP port %d, SSL" % (
                 config['server'], config['port']))
-            server = imaplib.IMAP4_SSL(config['server'], config['port'])
+            server = IMAP4_SSL(config['server'], config['port'])
         else:
             print ("Connecting to '%s' TCP port %d" % (
                 config['server'], config['port']))
-            server = imaplib.IMAP4(config['server'], config['port'])
+            server = IMAP4(config['server'], config['port'])
 
         # speed up interactions on TCP connections using small packets
         server.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # keepalive probes stop NAT gateways from dropping connections that
+        # wait idle in the folder worker pool
+        server.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in TCP_KEEPALIVE_OPTIONS:
+            if hasattr(socket, option):
+                server.sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
 
         print ("Logging in as '%s'" % (config['user']))
         server.login(config['user'], config['pass'])
@@ -1684,6 +2417,43 @@ def connect_and_login(config):
 
 
 
+def count_mbox_files(path):
+    """Returns the number of .mbox files directly in path"""
+    with os.scandir(path) as entries:
+        return sum(1 for entry in entries if entry.name.endswith('.mbox'))
+
+
+def list_s3_keys(config, prefix):
+    """Returns the keys of all S3 objects under prefix, or None if listing failed
+
+    Uses a boto3 paginator when available, otherwise 'aws s3 ls --recursive'.
+    """
+    if HAS_BOTO3:
+        import_boto3()
+        paginator = s3_client(config).get_paginator('list_objects_v2')
+        return [obj['Key']
+                for page in paginator.paginate(Bucket=config['s3_bucket'], Prefix=prefix)
+                for obj in page.get('Contents', [])]
+
+    cmd = [
+        'aws', 's3', 'ls',
+        's3://%s/%s' % (config['s3_bucket'], prefix),
+        '--endpoint-url', config['s3_endpoint'],
+        '--recursive'
+    ]
+    result = subprocess.run(cmd, env=aws_cli_env(config), capture_output=True, text=True, check=False)
+    if result.returncode != 0 or not result.stdout.strip():
+        return None
+
+    keys = []
+    for line in result.stdout.strip().split('\n'):
+        # Parse line format: "2025-10-10 14:30:00   12345  path/to/file"
+        parts = line.split(None, 3)
+        if len(parts) == 4:
+            keys.append(parts[3])
+    return keys
+
+
 def list_backups(global_config, accounts, account_filter):
     """List available backups for accounts (from local filesystem and/or S3)
 
@@ -1705,6 +2475,8 @@ def list_backups(global_config, accounts, account_filter):
     print ("")
 
     global_basedir = global_config.get('basedir', './backups')
+    global_s3 = global_config.get('s3') or {}
+    global_prefix = global_s3.get('prefix', S3_DEFAULTS['prefix'])
 
     for account in accounts:
         account_name = account.get('name', 'unknown')
@@ -1722,22 +2494,23 @@ def list_backups(global_config, accounts, account_filter):
             if use_date_folders:
                 # List date folders
                 try:
-                    entries = os.listdir(account_path)
-                    for entry in sorted(entries, reverse=True):
-                        entry_path = os.path.join(account_path, entry)
-                        if os.path.isdir(entry_path):
-                            # Count mbox files
-                            mbox_files = [f for f in os.listdir(entry_path) if f.endswith('.mbox')]
-                            if mbox_files:
-                                local_backups.append({'date': entry, 'files': len(mbox_files), 'path': entry_path})
+                    # scandir entries know their type without another stat()
+                    with os.scandir(account_path) as entries:
+                        date_dirs = sorted((entry for entry in entries if entry.is_dir()),
+                                           key=lambda entry: entry.name, reverse=True)
+                    for entry in date_dirs:
+                        # Count mbox files
+                        mbox_files = count_mbox_files(entry.path)
+                        if mbox_files:
+                            local_backups.append({'date': entry.name, 'files': mbox_files, 'path': entry.path})
                 except OSError as e:
                     pass
             else:
                 # List mbox files directly
                 try:
-                    mbox_files = [f for f in os.listdir(account_path) if f.endswith('.mbox')]
+                    mbox_files = count_mbox_files(account_path)
                     if mbox_files:
-                        local_backups.append({'date': 'N/A', 'files': len(mbox_files), 'path': account_path})
+                        local_backups.append({'date': 'N/A', 'files': mbox_files, 'path': account_path})
                 except OSError as e:
                     pass
 
@@ -1751,110 +2524,291 @@ def list_backups(global_config, accounts, account_filter):
         else:
             print ("  Local backups: None found")
 
-        # S3 BACKUPS
-        global_s3 = global_config.get('s3', {})
-        account_s3 = account.get('s3', {})
-        s3_enabled = account.get('s3_enabled', account_s3.get('enabled', global_s3.get('enabled', False)))
-
-        if s3_enabled:
-            print ("  S3 backups:")
-            s3_endpoint = account_s3.get('endpoint', global_s3.get('endpoint', ''))
-            s3_bucket = account_s3.get('bucket', global_s3.get('bucket', ''))
-            s3_access_key = account_s3.get('access_key', global_s3.get('access_key', ''))
-            s3_secret_key = account_s3.get('secret_key', global_s3.get('secret_key', ''))
-            global_prefix = global_s3.get('prefix', 'backups')
+        # S3 BACKUPS, account settings override global ones as in parse_account_config
+        s3 = collections.ChainMap(account.get('s3') or {}, global_s3, S3_DEFAULTS)
+        if not account.get('s3_enabled', s3['enabled']):
+            print ("")
+            continue
 
-            # Build S3 prefix for this account
-            if use_date_folders:
-                # List all date folders in S3
-                s3_prefix = '%s/%s/' % (global_prefix.rstrip('/'), account_name)
-            else:
-                s3_prefix = '%s/%s/' % (global_prefix.rstrip('/'), account_name)
+        print ("  S3 backups:")
+        s3_bucket = s3['bucket']
+        # Date folders, if used, are below the account prefix
+        s3_prefix = '%s/%s/' % (global_prefix.rstrip('/'), account_name)
 
-            try:
-                # Use AWS CLI to list objects
-                env = os.environ.copy()
-                env['AWS_ACCESS_KEY_ID'] = s3_access_key
-                env['AWS_SECRET_ACCESS_KEY'] = s3_secret_key
-
-                cmd = [
-                    'aws', 's3', 'ls',
-                    's3://%s/%s' % (s3_bucket, s3_prefix),
-                    '--endpoint-url', s3_endpoint,
-                    '--recursive'
-                ]
-
-                result = subprocess.run(cmd, env=env, capture_output=True, text=True, check=False)
-
-                if result.returncode == 0 and result.stdout.strip():
-                    # Parse output
-                    lines = result.stdout.strip().split('\n')
-                    s3_backups = {}
-
-                    for line in lines:
-                        # Parse line format: "2025-10-10 14:30:00   12345  path/to/file"
-                        parts = line.split()
-                        if len(parts) >= 4:
-                            s3_key = ' '.join(parts[3:])
-                            # Extract date from path if present
-                            if use_date_folders:
-                                # Extract date folder from path
-                                # Format: prefix/account_name/YYYY-MM-DD/file.mbox
-                                path_parts = s3_key.split('/')
-                                if len(path_parts) >= 3:
-                                    date_folder = path_parts[-2]
-                                    if date_folder not in s3_backups:
-                                        s3_backups[date_folder] = 0
-                                    if s3_key.endswith('.mbox') or s3_key.endswith('.mbox.gpg'):
-                                        s3_backups[date_folder] += 1
-                            else:
-                                # No date folders
-                                if 'latest' not in s3_backups:
-                                    s3_backups['latest'] = 0
-                                if s3_key.endswith('.mbox') or s3_key.endswith('.mbox.gpg'):
-                                    s3_backups['latest'] += 1
-
-                    if s3_backups:
-                        for date, count in sorted(s3_backups.items(), reverse=True):
-                            if date == 'latest':
-                                print ("    %d mbox files in s3://%s/%s" % (count, s3_bucket, s3_prefix))
-                            else:
-                                print ("    Date: %s (%d mbox files) in s3://%s/%s%s/" % (date, count, s3_bucket, s3_prefix, date))
+        try:
+            s3_keys = list_s3_keys({'s3_endpoint': s3['endpoint'], 's3_bucket': s3_bucket,
+                                    's3_access_key': s3['access_key'], 's3_secret_key': s3['secret_key']},
+                                   s3_prefix)
+
+            if s3_keys is not None:
+                s3_backups = {}
+
+                for s3_key in s3_keys:
+                    # Extract date from path if present
+                    if use_date_folders:
+                        # Extract date folder from path
+                        # Format: prefix/account_name/YYYY-MM-DD/file.mbox
+                        path_parts = s3_key.split('/')
+                        if len(path_parts) >= 3:
+                            date_folder = path_parts[-2]
+                            if date_folder not in s3_backups:
+                                s3_backups[date_folder] = 0
+                            if s3_key.endswith('.mbox') or s3_key.endswith('.mbox.gpg'):
+                                s3_backups[date_folder] += 1
                     else:
-                        print ("    None found")
+                        # No date folders
+                        if 'latest' not in s3_backups:
+                            s3_backups['latest'] = 0
+                        if s3_key.endswith('.mbox') or s3_key.endswith('.mbox.gpg'):
+                            s3_backups['latest'] += 1
+
+                if s3_backups:
+                    for date, count in sorted(s3_backups.items(), reverse=True):
+                        if date == 'latest':
+                            print ("    %d mbox files in s3://%s/%s" % (count, s3_bucket, s3_prefix))
+                        else:
+                            print ("    Date: %s (%d mbox files) in s3://%s/%s%s/" % (date, count, s3_bucket, s3_prefix, date))
                 else:
-                    print ("    Unable to list (check S3 credentials and permissions)")
+                    print ("    None found")
+            else:
+                print ("    Unable to list (check S3 credentials and permissions)")
 
-            except Exception as e:
-                print ("    Error listing S3: %s" % str(e))
+        except Exception as e:
+            print ("    Error listing S3: %s" % str(e))
 
         print ("")
 
 
 def create_basedir(basedir):
     """ Create the base directory on disk """
-    if os.path.isdir(basedir):
-        return
-
-    try:
-        os.makedirs(basedir)
-    except OSError as e:
-        raise
-
+    # no separate existence check, parallel accounts may share a parent
+    os.makedirs(basedir, exist_ok=True)
 
 
 def create_folder_structure(names,basedir):
     """ Create the folder structure on disk """
-    for imap_foldername, filename in sorted(names):
-        disk_foldername = os.path.split(filename)[0]
+    # makedirs creates the parents, so each directory is only needed once
+    disk_foldernames = set(os.path.split(filename)[0] for imap_foldername, filename in names)
+    for disk_foldername in disk_foldernames:
         if disk_foldername:
-            try:
-                # print "*** makedirs:", disk_foldername  # *DEBUG
-                disk_path = os.path.join(basedir,disk_foldername)
-                os.makedirs(disk_path)
-            except OSError as e:
-                if e.errno != 17:
+            os.makedirs(os.path.join(basedir,disk_foldername), exist_ok=True)
+
+
+def process_folder(server, foldername, filename, config, basedir):
+    """Backs up (or restores) a single folder over the given connection
+
+    Raises:
+        SkipFolderException: When the folder cannot be accessed
+    """
+    nospinner = config.get('nospinner', False)
+    if config.get('restore', False):
+        # RESTORE MODE: Upload messages from mbox files to IMAP server
+        fol_messages = scan_folder(server, foldername, nospinner)
+        fil_messages = scan_file(filename, False, nospinner, basedir)
+
+        # Find messages that are in file but not on server
+        messages_to_upload = {msg_id: msg_id for msg_id in fil_messages.keys() - fol_messages.keys()}
+
+        upload_messages(server, foldername, filename, messages_to_upload,
+                        nospinner, basedir)
+    else:
+        # BACKUP MODE: Download messages from IMAP server to mbox files
+        fol_messages = scan_folder(server, foldername, nospinner)
+        fil_messages = scan_file(filename, config.get('overwrite', False),
+                                 nospinner, basedir)
+        new_messages = {msg_id: fol_messages[msg_id] for msg_id in fol_messages.keys() - fil_messages.keys()}
+
+        download_messages(server, filename, new_messages, config.get('overwrite', False),
+                          nospinner, config.get('thunderbird', False),
+                          basedir, config.get('icloud', False))
+
+
+class FolderOutput:
+    """Stands in for sys.stdout while folders or accounts are processed in parallel
+
+    Output written by a worker thread is held back until its folder is
+    done and then printed as one block, so lines from different folders
+    don't interleave.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def begin(self, parent=None):
+        """Start collecting output of the current thread
+
+        With a parent buffer (see current()) the collected output is added
+        to it instead of being printed, for folders of an account that is
+        itself processed in parallel.
+        """
+        self.local.buffer = []
+        self.local.parent = parent
+
+    def current(self):
+        """Returns the buffer of the current thread, or None"""
+        return getattr(self.local, 'buffer', None)
+
+    def end(self):
+        """Print collected output of the current thread"""
+        buffer = self.local.buffer
+        self.local.buffer = None
+        with self.lock:
+            if self.local.parent is not None:
+                self.local.parent.append(''.join(buffer))
+            else:
+                self.stream.write(''.join(buffer))
+                self.stream.flush()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            with self.lock:
+                self.stream.write(text)
+        else:
+            buffer.append(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_parallel(function, items, workers):
+    """Calls function for each item on a pool of threads, returns the results in order
+
+    Output of each call is printed as one block when it is done.
+    """
+    if isinstance(sys.stdout, FolderOutput):
+        # already inside a parallel account or folder
+        output = sys.stdout
+        parent = output.current()
+    else:
+        output = FolderOutput(sys.stdout)
+        parent = None
+
+    def run_one(item):
+        output.begin(parent)
+        try:
+            return function(item)
+        finally:
+            output.end()
+
+    stdout = sys.stdout
+    sys.stdout = output
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_one, item) for item in items]
+            return [future.result() for future in futures]
+    finally:
+        sys.stdout = stdout
+
+
+def connect_folder_worker(config):
+    """Opens an extra connection for a folder worker
+
+    Raises:
+        SkipFolderException: When the connection cannot be established
+    """
+    try:
+        return connect_and_login(config)
+    except SystemExit:
+        # connect_and_login has already printed the reason
+        raise SkipFolderException("ERROR: Could not open an extra connection to '%s'" % config['server'])
+
+
+def process_folders_parallel(server, names, config, basedir, workers):
+    """Processes folders on a pool of threads, each with its own connection
+
+    The already logged in server connection is the first in the pool,
+    further connections are opened as threads need them, up to workers.
+    """
+    # spinners of concurrent folders would overwrite each other
+    worker_config = dict(config)
+    worker_config['nospinner'] = True
+
+    connections = queue.Queue()
+    connections.put(server)
+    opened = [server]
+    opened_lock = threading.Lock()
+    if isinstance(sys.stdout, FolderOutput):
+        # accounts are processed in parallel too, folder output goes
+        # into the output of this account
+        output = sys.stdout
+        parent = output.current()
+    else:
+        output = FolderOutput(sys.stdout)
+        parent = None
+
+    def open_or_wait():
+        """Opens another connection, or waits for a free one when the
+        server refuses more connections"""
+        try:
+            conn = connect_folder_worker(worker_config)
+        except SkipFolderException:
+            with opened_lock:
+                if not opened:
                     raise
+            print ("WARNING: Server refused another connection, waiting for a free one")
+            while True:
+                try:
+                    return connections.get(timeout=1)
+                except queue.Empty:
+                    # connections of failed folders are dropped
+                    with opened_lock:
+                        if not opened:
+                            raise SkipFolderException(
+                                "ERROR: No connection left to '%s'" % config['server'])
+        with opened_lock:
+            opened.append(conn)
+        return conn
+
+    def process_one(foldername, filename):
+        output.begin(parent)
+        try:
+            try:
+                conn = connections.get_nowait()
+            except queue.Empty:
+                conn = open_or_wait()
+            try:
+                process_folder(conn, foldername, filename, worker_config, basedir)
+            except:
+                # the connection may be broken, drop it so the next
+                # folder opens a fresh one
+                with opened_lock:
+                    opened.remove(conn)
+                try:
+                    conn.logout()
+                except Exception:
+                    pass
+                raise
+            connections.put(conn)
+        except SkipFolderException as e:
+            print (e)
+        finally:
+            output.end()
+
+    print ("Processing %d folder(s) with %d workers" % (len(names), workers))
+    stdout = sys.stdout
+    sys.stdout = output
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(process_one, foldername, filename)
+                       for foldername, filename in names]
+            for future in futures:
+                future.result()
+    finally:
+        sys.stdout = stdout
+
+        print ("Disconnecting")
+        for conn in opened:
+            try:
+                conn.logout()
+            except Exception as e:
+                print ("WARNING: Error disconnecting: %s" % str(e))
 
 
 def process_account(config):
@@ -1864,16 +2818,7 @@ def process_account(config):
         print ("ERROR: Account config missing required fields (server, user)")
         return False
 
-    # Set port defaults if not specified
-    if 'port' not in config:
-        if config.get('usessl', True):
-            config['port'] = 993
-        else:
-            config['port'] = 143
-
-    # Set timeout default if not specified
-    if 'timeout' not in config:
-        config['timeout'] = 60
+    set_connection_defaults(config)
 
     # Connect to server
     try:
@@ -1885,8 +2830,8 @@ def process_account(config):
     # Get folder names
     names = get_names(server, config.get('thunderbird', False), config.get('nospinner', False))
 
-    # Filter folders
-    exclude_folders = []
+    # Filter folders, the names are kept in sets for the per-folder lookups
+    exclude_folders = set()
     if config.get('folders') and config.get('exclude-folders'):
         print ("ERROR: Cannot use both 'folders' and 'exclude_folders' for account '%s'" % config.get('account_name', 'unknown'))
         server.logout()
@@ -1895,19 +2840,19 @@ def process_account(config):
     if config.get('folders'):
         # Handle both string (comma-separated) and already-split list
         if isinstance(config['folders'], str):
-            dirs = list(map(lambda x: x.strip(), config['folders'].split(',')))
+            dirs = set(x.strip() for x in config['folders'].split(','))
         else:
-            dirs = config['folders'] if isinstance(config['folders'], list) else [config['folders']]
+            dirs = set(config['folders'] if isinstance(config['folders'], list) else [config['folders']])
 
         if config.get('thunderbird', False):
-            dirs = [i.replace("Inbox", "INBOX", 1) if i.startswith("Inbox") else i for i in dirs]
-        names = list(filter(lambda x: x[0] in dirs, names))
+            dirs = set(i.replace("Inbox", "INBOX", 1) if i.startswith("Inbox") else i for i in dirs)
+        names = [name for name in names if name[0] in dirs]
     elif config.get('exclude-folders'):
         # Handle both string (comma-separated) and already-split list
         if isinstance(config['exclude-folders'], str):
-            exclude_folders = list(map(lambda x: x.strip(), config['exclude-folders'].split(',')))
+            exclude_folders = set(x.strip() for x in config['exclude-folders'].split(','))
         else:
-            exclude_folders = config['exclude-folders'] if isinstance(config['exclude-folders'], list) else [config['exclude-folders']]
+            exclude_folders = set(config['exclude-folders'] if isinstance(config['exclude-folders'], list) else [config['exclude-folders']])
 
     # Setup base directory
     basedir = config.get('basedir', '.')
@@ -1950,6 +2895,10 @@ def process_account(config):
                     download_filename = filename + '.gpg'
 
                 print ("Downloading: %s" % download_filename)
+                # the files are replaced, an index of the old local ones
+                # would hide messages of the restored mbox from scan_file
+                remove_index(basedir, download_filename)
+                remove_index(basedir, filename)
                 try:
                     # Download from S3
                     downloaded_file = download_from_s3(download_filename, config, basedir)
@@ -1976,46 +2925,32 @@ def process_account(config):
             print ("ERROR during S3 download: %s" % str(e))
 
     # Process each folder
-    for name_pair in names:
-        try:
-            foldername, filename = name_pair
+    folder_workers = config.get('folder_workers', 1)
+    if folder_workers > 1:
+        names_to_process = []
+        for foldername, filename in names:
             # Skip excluded folders
             if foldername in exclude_folders:
                 print (f'Excluding folder "{foldername}"')
                 continue
+            names_to_process.append((foldername, filename))
+        process_folders_parallel(server, names_to_process, config, basedir, folder_workers)
+    else:
+        for name_pair in names:
+            try:
+                foldername, filename = name_pair
+                # Skip excluded folders
+                if foldername in exclude_folders:
+                    print (f'Excluding folder "{foldername}"')
+                    continue
 
-            if config.get('restore', False):
-                # RESTORE MODE: Upload messages from mbox files to IMAP server
-                fol_messages = scan_folder(server, foldername, config.get('nospinner', False))
-                fil_messages = scan_file(filename, False, config.get('nospinner', False), basedir)
-
-                # Find messages that are in file but not on server
-                messages_to_upload = {}
-                for msg_id in fil_messages.keys():
-                    if msg_id not in fol_messages:
-                        messages_to_upload[msg_id] = msg_id
-
-                upload_messages(server, foldername, filename, messages_to_upload,
-                              config.get('nospinner', False), basedir)
-            else:
-                # BACKUP MODE: Download messages from IMAP server to mbox files
-                fol_messages = scan_folder(server, foldername, config.get('nospinner', False))
-                fil_messages = scan_file(filename, config.get('overwrite', False),
-                                       config.get('nospinner', False), basedir)
-                new_messages = {}
-                for msg_id in fol_messages.keys():
-                    if msg_id not in fil_messages:
-                        new_messages[msg_id] = fol_messages[msg_id]
-
-                download_messages(server, filename, new_messages, config.get('overwrite', False),
-                                config.get('nospinner', False), config.get('thunderbird', False),
-                                basedir, config.get('icloud', False))
+                process_folder(server, foldername, filename, config, basedir)
 
-        except SkipFolderException as e:
-            print (e)
+            except SkipFolderException as e:
+                print (e)
 
-    print ("Disconnecting")
-    server.logout()
+        print ("Disconnecting")
+        server.logout()
 
     # S3 Upload: Process and upload mbox files after backup
     if config.get('s3_upload') and not config.get('restore'):
@@ -2058,16 +2993,19 @@ def process_account(config):
                 print ("=" * 70)
                 return False  # Mark account as failed
 
-            # Upload files to S3
+            # Upload files to S3, they are independent so several at once
             print ("\nUploading %d file(s) to S3..." % len(files_to_upload))
-            for file_path in files_to_upload:
-                filename = os.path.basename(file_path)
-                print ("Processing: %s" % filename)
+
+            def upload_one(file_path):
+                print ("Processing: %s" % os.path.basename(file_path))
                 try:
                     upload_to_s3(file_path, config)
                 except Exception as e:
                     print ("  ERROR: %s" % str(e))
 
+            if files_to_upload:
+                run_parallel(upload_one, files_to_upload, S3_UPLOAD_WORKERS)
+
             print ("\nS3 upload complete")
 
         finally:
@@ -2132,11 +3070,18 @@ def main():
             if date_override:
                 print ("Date override active: %s\n" % date_override)
 
-            # Process each account
-            success_count = 0
-            failed_count = 0
+            # Number of accounts processed in parallel
+            try:
+                account_workers = int(config.get('account_workers', global_config.get('account_workers', 1)))
+                if account_workers <= 0:
+                    raise ValueError
+            except (TypeError, ValueError):
+                print ("ERROR: Invalid account_workers value. Must be an integer greater than 0.")
+                sys.exit(2)
+            parallel = account_workers > 1 and len(accounts) > 1
 
-            for i, account in enumerate(accounts, 1):
+            def run_account(i, account):
+                """Processes one account of the config file, returns True on success"""
                 account_name = account.get('name', 'unknown')
                 print ("=" * 70)
                 print ("Processing account %d/%d: %s" % (i, len(accounts), account_name))
@@ -2149,15 +3094,32 @@ def main():
                 if restore_mode:
                     account_config['restore'] = True
 
+                # Override folder workers if specified on command line
+                if 'folder_workers' in config:
+                    account_config['folder_workers'] = config['folder_workers']
+
+                # spinners of concurrent accounts would overwrite each other
+                if parallel:
+                    account_config['nospinner'] = True
+
                 # Process the account
                 success = process_account(account_config)
 
                 if success:
-                    success_count += 1
                     print ("\n✓ Account '%s' completed successfully\n" % account_name)
                 else:
-                    failed_count += 1
                     print ("\n✗ Account '%s' failed\n" % account_name)
+                return success
+
+            if parallel:
+                print ("Processing %d account(s) with %d workers\n" % (len(accounts), account_workers))
+                results = run_parallel(lambda item: run_account(*item),
+                                       list(enumerate(accounts, 1)), account_workers)
+            else:
+                results = [run_account(i, account) for i, account in enumerate(accounts, 1)]
+
+            success_count = len([success for success in results if success])
+            failed_count = len(results) - success_count
 
             # Summary
             print ("=" * 70)
@@ -2202,53 +3164,6 @@ if sys.stdin.isatty():
     sys.excepthook = cli_exception
 
 
-# Hideous fix to counteract http://python.org/sf/1092502
-# (which should have been fixed ages ago.)
-# Also see http://python.org/sf/1441530
-def _fixed_socket_read(self, size=-1):
-    data = self._rbuf
-    if size < 0:
-        # Read until EOF
-        buffers = []
-        if data:
-            buffers.append(data)
-        self._rbuf = ""
-        if self._rbufsize <= 1:
-            recv_size = self.default_bufsize
-        else:
-            recv_size = self._rbufsize
-        while True:
-            data = self._sock.recv(recv_size)
-            if not data:
-                break
-            buffers.append(data)
-        return "".join(buffers)
-    else:
-        # Read until size bytes or EOF seen, whichever comes first
-        buf_len = len(data)
-        if buf_len >= size:
-            self._rbuf = data[size:]
-            return data[:size]
-        buffers = []
-        if data:
-            buffers.append(data)
-        self._rbuf = ""
-        while True:
-            left = size - buf_len
-            recv_size = min(self._rbufsize, left)  # the actual fix
-            data = self._sock.recv(recv_size)
-            if not data:
-                break
-            buffers.append(data)
-            n = len(data)
-            if n >= left:
-                self._rbuf = data[left:]
-                buffers[-1] = data[:left]
-                break
-            buf_len += n
-        return "".join(buffers)
-
-    
 if __name__ == '__main__':
     gc.enable()
     main()
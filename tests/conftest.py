@@ -119,8 +119,75 @@ def capture_output(monkeypatch):
     return output
 
 
+@pytest.fixture
+def fake_imap_server():
+    """Runs scripted IMAP servers on localhost, returns connect(handlers, ...)
+
+    handlers maps an upper case command (bytes) to handler(tag, args, rfile)
+    returning the bytes to send back, rfile reads any literal that follows.
+    CAPABILITY, EXAMINE and LOGOUT are answered unless a handler is given.
+    connect() returns an imapbackup.IMAP4 client connected to a new server.
+    """
+    import socket
+    import threading
+    import imapbackup
+
+    started = []
+    default_timeout = socket.getdefaulttimeout()
+
+    def connect(handlers, greeting=b'* PREAUTH ready',
+                capabilities=b'IMAP4rev1', exists=0):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+
+        def serve():
+            conn, _ = listener.accept()
+            f = conn.makefile('rb')
+            conn.sendall(greeting + b'\r\n')
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                tag, cmd, args = (line.strip().split(b' ', 2) + [b''])[:3]
+                cmd = cmd.upper()
+                if cmd in handlers:
+                    conn.sendall(handlers[cmd](tag, args, f))
+                elif cmd == b'CAPABILITY':
+                    conn.sendall(b'* CAPABILITY ' + capabilities + b'\r\n' + tag + b' OK done\r\n')
+                elif cmd == b'EXAMINE':
+                    conn.sendall(b'* %d EXISTS\r\n' % exists + tag + b' OK [READ-ONLY] done\r\n')
+                elif cmd == b'LOGOUT':
+                    conn.sendall(b'* BYE\r\n' + tag + b' OK done\r\n')
+                    break
+            conn.close()
+
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        # IMAP4 only takes a timeout argument from Python 3.9 on
+        socket.setdefaulttimeout(5)
+        server = imapbackup.IMAP4('127.0.0.1', listener.getsockname()[1])
+        started.append((server, thread, listener))
+        return server
+
+    yield connect
+
+    for server, thread, listener in started:
+        if server.state != 'LOGOUT':
+            try:
+                server.logout()
+            except Exception:
+                pass
+        thread.join(5)
+        listener.close()
+    socket.setdefaulttimeout(default_timeout)
+
+
 @pytest.fixture(autouse=True)
 def reset_modules():
     """Reset module state between tests"""
     yield
-    # Could add cleanup code here if needed
+    # Tool availability is cached per process, tests mock it differently
+    import imapbackup
+    imapbackup.have_tool.cache_clear()
+    imapbackup.IMPORTED_GPG_KEYS.clear()
@@ -1,6 +1,7 @@
 """
 Tests for batch processing and memory optimization in scan_folder
 """
+import os
 import pytest
 from unittest.mock import Mock, MagicMock, patch, call
 import imapbackup
@@ -63,9 +64,8 @@ class TestScanFolderBatching:
         """Helper to create mock header responses"""
         data = []
         for i in range(start, end + 1):
-            msg_id = f'<test{i}@example.com>'
-            header_bytes = f'Message-Id: {msg_id}\r\n'.encode('utf-8')
-            data.append((f'{i} (BODY[HEADER.FIELDS (MESSAGE-ID)] {{...}}'.encode(), header_bytes))
+            data.append((b'%d (BODY[HEADER.FIELDS (MESSAGE-ID)] {...}' % i,
+                         b'Message-Id: <test%d@example.com>\r\n' % i))
             data.append(b')')
         return data
 
@@ -93,8 +93,8 @@ class TestScanFolderBatching:
         assert len(messages) == num_msgs
         # Should fetch once for single batch
         assert mock_imap_server.fetch.call_count >= 1
-        # gc.collect should be called after batch processing
-        assert mock_gc.called
+        # batches are freed by refcounting, no forced collection
+        assert not mock_gc.called
 
     @patch('imapbackup.gc.collect')
     @patch('imapbackup.retry_on_network_error')
@@ -136,8 +136,8 @@ class TestScanFolderBatching:
         # At least 3 batch fetches should have occurred
         assert len(fetch_calls) >= 3
 
-        # gc.collect should be called multiple times (once per batch)
-        assert mock_gc.call_count >= 3
+        # batches are freed by refcounting, no forced collection
+        assert not mock_gc.called
 
     @patch('imapbackup.retry_on_network_error')
     def test_scan_folder_batch_ranges(self, mock_retry, mock_imap_server):
@@ -204,7 +204,7 @@ class TestScanFolderBatching:
 
     @patch('imapbackup.retry_on_network_error')
     def test_scan_folder_memory_cleanup(self, mock_retry, mock_imap_server):
-        """Test that memory is cleaned up after each batch"""
+        """Test that no full garbage collection is forced after each batch"""
         num_msgs = 1500
         mock_imap_server.select.return_value = ('OK', [str(num_msgs).encode()])
 
@@ -220,10 +220,10 @@ class TestScanFolderBatching:
             try:
                 imapbackup.scan_folder(mock_imap_server, 'INBOX', nospinner=True)
             except:
-                pass  # May fail but we just need to verify gc was called
+                pass  # May fail but we just need to verify gc was not called
 
-            # gc.collect should be called at least once per batch
-            assert mock_gc.called
+            # the previous batch is freed as soon as data is rebound
+            assert not mock_gc.called
 
 
 @pytest.mark.unit
@@ -260,3 +260,182 @@ class TestMemoryOptimization:
         # Memory saved: 90% reduction in peak memory usage
         memory_reduction = (num_msgs - max_messages_in_memory) / num_msgs
         assert memory_reduction == 0.9
+
+
+@pytest.mark.unit
+class TestSequenceSet:
+    """Tests for IMAP sequence set compression"""
+
+    def test_compress_sequence_set_ranges(self):
+        """Test consecutive numbers are coalesced into ranges"""
+        assert imapbackup.compress_sequence_set([1, 2, 3, 7, 9, 10]) == '1:3,7,9:10'
+
+    def test_compress_sequence_set_unsorted(self):
+        """Test input order does not matter"""
+        assert imapbackup.compress_sequence_set([5, 4, 1]) == '1,4:5'
+
+    def test_compress_sequence_set_empty(self):
+        """Test empty input yields empty set"""
+        assert imapbackup.compress_sequence_set([]) == ''
+
+
+@pytest.mark.integration
+class TestMissingMessageIds:
+    """Tests for synthesising Message-Ids for messages without one"""
+
+    @patch('imapbackup.retry_on_network_error')
+    def test_missing_ids_fetched_in_one_command(self, mock_retry, mock_imap_server):
+        """Test that messages lacking a Message-Id are fetched with a single FETCH"""
+        num_msgs = 10
+        mock_imap_server.select.return_value = ('OK', [str(num_msgs).encode()])
+        mock_retry.side_effect = lambda func, **kwargs: func()
+
+        fetch_calls = []
+
+        def mock_fetch(msg_range, fetch_cmd):
+            fetch_calls.append((msg_range, fetch_cmd))
+            if 'MESSAGE-ID' in fetch_cmd:
+                data = []
+                for i in range(1, num_msgs + 1):
+                    # Every other message has no Message-Id
+                    header = b'Message-Id: <test%d@example.com>\r\n' % i if i % 2 else b'\r\n'
+                    data.append((b'%d (BODY[HEADER.FIELDS (MESSAGE-ID)] {...}' % i, header))
+                    data.append(b')')
+                return ('OK', data)
+            data = []
+            for i in (2, 4, 6, 8, 10):
+                data.append((b'%d (BODY[HEADER.FIELDS (FROM TO CC DATE SUBJECT)] {...}' % i,
+                             b'Subject: message %d\r\n\r\n' % i))
+                data.append(b')')
+            return ('OK', data)
+
+        mock_imap_server.fetch.side_effect = mock_fetch
+
+        messages = imapbackup.scan_folder(mock_imap_server, 'Sent', nospinner=True)
+
+        assert len(messages) == num_msgs
+        assert len(fetch_calls) == 2
+        assert fetch_calls[1][0] == '2,4,6,8,10'
+        synthesized = [k for k in messages if imapbackup.UUID in k]
+        assert sorted(messages[k] for k in synthesized) == [2, 4, 6, 8, 10]
+
+
+@pytest.mark.integration
+class TestDownloadBatching:
+    """Tests for batched FETCH in download_messages"""
+
+    @patch('imapbackup.DOWNLOAD_BATCH_SIZE', 100)
+    @patch('imapbackup.retry_on_network_error')
+    def test_download_messages_fetches_in_batches(self, mock_retry, mock_imap_server, temp_dir):
+        """Test that messages are downloaded with one FETCH per batch"""
+        mock_retry.side_effect = lambda func, **kwargs: func()
+        fetch_calls = []
+
+        def mock_fetch(msg_set, fetch_cmd):
+            start, end = map(int, msg_set.split(':'))
+            if fetch_cmd == '(RFC822.SIZE)':
+                return ('OK', [b'%d (RFC822.SIZE 100)' % i for i in range(start, end + 1)])
+            fetch_calls.append(msg_set)
+            data = []
+            for i in range(start, end + 1):
+                if i == 150:
+                    continue  # server returns nothing for this one
+                data.append((b'%d (RFC822 {...}' % i, b'Message-Id: <test%d@example.com>\r\n\r\nbody\r\n' % i))
+                data.append(b')')
+            return ('OK', data)
+
+        mock_imap_server.fetch.side_effect = mock_fetch
+        messages = dict(('<test%d@example.com>' % i, i) for i in range(1, 251))
+
+        result = imapbackup.download_messages(mock_imap_server, 'INBOX.mbox', messages,
+                                              False, True, False, temp_dir, False)
+
+        assert fetch_calls == ['1:100', '101:200', '201:250']
+        assert result[:2] == (249, 1)
+        assert len(imapbackup.scan_file('INBOX.mbox', False, True, temp_dir)) == 249
+
+    @patch('imapbackup.FETCH_BATCH_SIZE', 4)
+    @patch('imapbackup.retry_on_network_error')
+    def test_missing_ids_fetched_per_batch(self, mock_retry, mock_imap_server):
+        """Test that header fetches for missing ids stay within a batch"""
+        num_msgs = 10
+        mock_imap_server.select.return_value = ('OK', [str(num_msgs).encode()])
+        mock_retry.side_effect = lambda func, **kwargs: func()
+
+        header_fetches = []
+
+        def mock_fetch(msg_range, fetch_cmd):
+            if 'MESSAGE-ID' in fetch_cmd:
+                start, end = map(int, msg_range.split(':'))
+                data = []
+                for i in range(start, end + 1):
+                    header = b'Message-Id: <test%d@example.com>\r\n' % i if i % 2 else b'\r\n'
+                    data.append((b'%d (BODY[HEADER.FIELDS (MESSAGE-ID)] {...}' % i, header))
+                    data.append(b')')
+                return ('OK', data)
+            header_fetches.append(msg_range)
+            data = []
+            for i in map(int, msg_range.split(',')):
+                data.append((b'%d (BODY[HEADER.FIELDS (FROM TO CC DATE SUBJECT)] {...}' % i,
+                             b'Subject: message %d\r\n\r\n' % i))
+                data.append(b')')
+            return ('OK', data)
+
+        mock_imap_server.fetch.side_effect = mock_fetch
+
+        messages = imapbackup.scan_folder(mock_imap_server, 'Sent', nospinner=True)
+
+        assert len(messages) == num_msgs
+        assert header_fetches == ['2,4', '6,8', '10']
+        # the header fetches go through the retry wrapper too
+        assert mock_retry.call_count == 1 + 6
+
+    @patch('imapbackup.DOWNLOAD_BATCH_BYTES', 1000)
+    def test_download_batches_limited_by_size(self):
+        """Test batches are cut by total size and unknown sizes go alone"""
+        sizes = {1: 400, 2: 400, 3: 400, 4: 5000, 6: 10}
+        batches = list(imapbackup.download_batches([1, 2, 3, 4, 5, 6], sizes))
+        assert batches == [[1, 2], [3], [4], [5], [6]]
+
+    @patch('imapbackup.DOWNLOAD_BATCH_SIZE', 2)
+    def test_download_batches_limited_by_count(self):
+        """Test batches never hold more than DOWNLOAD_BATCH_SIZE messages"""
+        sizes = dict((i, 1) for i in range(1, 6))
+        batches = list(imapbackup.download_batches([1, 2, 3, 4, 5], sizes))
+        assert batches == [[1, 2], [3, 4], [5]]
+
+    def test_download_messages_pipelines_fetch(self, temp_dir, fake_imap_server):
+        """Test the next download batch is requested before the previous one is answered"""
+        def message(num):
+            return b'From: a@example.com\r\nMessage-Id: <m%d@example.com>\r\n\r\nBody %d\r\n' % (num, num)
+
+        fetches = []
+
+        def fetch(tag, args, rfile):
+            if b'RFC822.SIZE' in args:
+                return b''.join(b'* %d FETCH (RFC822.SIZE %d)\r\n' % (num, len(message(num)))
+                                for num in range(1, 5)) + tag + b' OK done\r\n'
+            fetches.append((tag, args.split(b' ', 1)[0]))
+            # a client waiting for each response would hang here
+            if len(fetches) < 2:
+                return b''
+            out = b''
+            for tag, msg_set in fetches:
+                start, end = map(int, msg_set.split(b':'))
+                for num in range(start, end + 1):
+                    out += b'* %d FETCH (RFC822 {%d}\r\n%s)\r\n' % (num, len(message(num)), message(num))
+                out += tag + b' OK FETCH completed\r\n'
+            return out
+
+        server = fake_imap_server({b'FETCH': fetch}, exists=4)
+        server.select('INBOX', readonly=True)
+        messages = dict(('<m%d@example.com>' % i, i) for i in range(1, 5))
+        with patch('imapbackup.DOWNLOAD_BATCH_SIZE', 2):
+            result = imapbackup.download_messages(server, 'INBOX.mbox', messages, False,
+                                                  True, False, temp_dir, False)
+
+        assert result[:2] == (4, 0)
+        with open(os.path.join(temp_dir, 'INBOX.mbox'), 'rb') as f:
+            content = f.read()
+        for num in range(1, 5):
+            assert b'Body %d' % num in content
@@ -157,6 +157,25 @@ class TestGPGSecurityIntegration:
 
         assert result is None
 
+    @patch('subprocess.run')
+    def test_tool_check_is_cached(self, mock_subprocess):
+        """Test the --version probe runs only once per tool"""
+        assert imapbackup.have_tool('gpg') is True
+        assert imapbackup.have_tool('gpg') is True
+        assert mock_subprocess.call_count == 1
+
+    @patch('subprocess.run')
+    def test_same_key_imported_once(self, mock_subprocess):
+        """Test importing the same key material again skips gpg"""
+        key = "-----BEGIN PGP PUBLIC KEY BLOCK-----\nabc\n-----END PGP PUBLIC KEY BLOCK-----\n"
+        fpr = "A" * 40
+        mock_subprocess.return_value = Mock(stdout="fpr:::::::::%s:\n" % fpr, stderr="")
+
+        assert imapbackup.import_gpg_key(key) == fpr
+        calls = mock_subprocess.call_count
+        assert imapbackup.import_gpg_key(key) == fpr
+        assert mock_subprocess.call_count == calls
+
     def test_security_message_printed_on_failure(self, capsys):
         """Test that security warnings are printed when GPG import fails"""
         # Call import_gpg_key with invalid input
@@ -110,6 +110,27 @@ class TestMessageIDHandling:
 
         assert "  " not in result or result.count("  ") < text.count("  ")
 
+    def test_message_id_from_header(self):
+        """Test message_id_from_header collapses whitespace and rejects empty ids"""
+        header = "Message-ID:  <test@\r\n example.com>  \r\n"
+        assert imapbackup.message_id_from_header(header) == "<test@ example.com>"
+        assert imapbackup.message_id_from_header("Message-Id:   \r\n") is None
+        assert imapbackup.message_id_from_header("Subject: hi") is None
+
+    def test_message_id_from_header_matches_regex(self):
+        """Test the fast path gives the same key as MSGID_RE"""
+        for header in ("Message-Id: <a@b>", "message-id:<a@b>", "MESSAGE-ID: <a@b> (comment)\r\n",
+                       "Message-Id:\r\n <a@\r\n\tb>", "X-Message-Id: <a@b>", "Message-Id: x"):
+            normalized = ' '.join(header.split())
+            match = imapbackup.MSGID_RE.match(normalized)
+            expected = match.group(1) if match else None
+            assert imapbackup.message_id_from_header(header) == expected
+
+    def test_message_digest_is_sha1(self):
+        """Test synthesised ids keep using SHA-1 so existing backups still match"""
+        header = b"From: a@example.com\tSubject: hi"
+        assert imapbackup.message_digest(header) == hashlib.sha1(header).hexdigest()
+
     def test_uuid_constant(self):
         """Test UUID constant is defined"""
         assert hasattr(imapbackup, 'UUID')
@@ -147,6 +168,15 @@ class TestParseList:
         assert isinstance(result, list)
         assert len(result) > 0
 
+    def test_parse_paren_list_nested(self):
+        """Test nested lists are parsed and the end index is returned"""
+        row = r'(\HasChildren (\Noselect)) "/" "INBOX"'
+        result, end = imapbackup.parse_paren_list(row)
+
+        assert result == ['\\HasChildren', ['\\Noselect']]
+        assert row[end:] == ' "/" "INBOX"'
+        assert imapbackup.parse_string_list(row, end) == ['/', 'INBOX']
+
     def test_parse_string_list(self):
         """Test parsing string list"""
         row = r'" / " "INBOX"'
@@ -173,29 +203,188 @@ class TestScanFile:
         result = imapbackup.scan_file("test.mbox", True, True, temp_dir)
         assert result == {}
 
-    @patch('mailbox.mbox')
-    def test_scan_file_with_messages(self, mock_mbox, temp_dir, sample_mbox_content):
+    def test_scan_file_with_messages(self, temp_dir, sample_mbox_content):
         """Test scan_file with valid mbox file"""
         # Create a temporary mbox file
         mbox_file = os.path.join(temp_dir, "test.mbox")
         with open(mbox_file, 'wb') as f:
             f.write(sample_mbox_content)
 
-        # Create mock message objects
-        mock_msg1 = MagicMock()
-        mock_msg1.get.return_value = "<test1@example.com>"
+        result = imapbackup.scan_file("test.mbox", False, True, temp_dir)
 
-        mock_msg2 = MagicMock()
-        mock_msg2.get.return_value = "<test2@example.com>"
+        # Should find 2 messages
+        assert len(result) == 2
+        assert "<test1@example.com>" in result
+        assert "<test2@example.com>" in result
 
-        mock_mbox_instance = MagicMock()
-        mock_mbox_instance.__iter__.return_value = [mock_msg1, mock_msg2]
-        mock_mbox.return_value = mock_mbox_instance
+    def test_scan_file_folded_and_missing_message_id(self, temp_dir, capsys):
+        """Test scan_file unfolds Message-Id headers and warns on missing ones"""
+        mbox_file = os.path.join(temp_dir, "test.mbox")
+        with open(mbox_file, 'wb') as f:
+            f.write(b"From nobody Wed Oct 10 12:00:00 2025\n"
+                    b"MESSAGE-ID:\n  <folded@example.com>\n"
+                    b"Subject: Folded\n\nBody\n\n"
+                    b"From nobody Wed Oct 10 12:01:00 2025\n"
+                    b"Subject: No id\n\nBody\n"
+                    b"Message-Id: <in-body@example.com>\n\n")
 
         result = imapbackup.scan_file("test.mbox", False, True, temp_dir)
 
-        # Should find 2 messages
-        assert len(result) == 2
+        assert list(result) == ["<folded@example.com>"]
+        captured = capsys.readouterr()
+        assert "has no Message-Id header" in captured.out
+
+    def test_iter_mbox_headers(self):
+        """Test iter_mbox_headers yields only header blocks, including empty ones"""
+        mbox = (b"preamble\n"
+                b"From a\nSubject: one\r\n\r\nbody\n"
+                b"From b\n\nno headers\n"
+                b"From c\nSubject: no body\n"
+                b"From d\n")
+        assert list(imapbackup.iter_mbox_headers(mbox)) == [
+            b"Subject: one\r\n", b"", b"Subject: no body\n", b""]
+        assert list(imapbackup.iter_mbox_headers(b"")) == []
+
+    def test_scan_file_empty(self, temp_dir):
+        """Test scan_file handles an empty mbox file which cannot be mapped"""
+        open(os.path.join(temp_dir, "test.mbox"), 'wb').close()
+        assert imapbackup.scan_file("test.mbox", False, True, temp_dir) == {}
+
+    def test_scan_file_uses_index(self, temp_dir, sample_mbox_content, capsys):
+        """Test scan_file writes a Message-Id index and skips parsing while it is current"""
+        mbox_file = os.path.join(temp_dir, "test.mbox")
+        index_file = imapbackup.index_path(temp_dir, "test.mbox")
+        with open(mbox_file, 'wb') as f:
+            f.write(sample_mbox_content)
+
+        first = imapbackup.scan_file("test.mbox", False, True, temp_dir)
+        with open(index_file) as f:
+            assert f.readline() == imapbackup.index_stamp(mbox_file)
+            assert f.read().split() == list(first)
+
+        # a current index is trusted without reading the mbox
+        with open(index_file, 'w') as f:
+            f.write(imapbackup.index_stamp(mbox_file) + "<indexed@example.com>\n")
+        assert list(imapbackup.scan_file("test.mbox", False, True, temp_dir)) == \
+            ["<indexed@example.com>"]
+        assert "(from index)" in capsys.readouterr().out
+
+        # an mbox with another mtime, even an older one, is parsed again
+        os.utime(mbox_file, (0, 0))
+        assert imapbackup.scan_file("test.mbox", False, True, temp_dir) == first
+        with open(index_file) as f:
+            assert f.readline() == imapbackup.index_stamp(mbox_file)
+            assert f.read().split() == list(first)
+
+    def test_index_kept_outside_mbox_tree(self, temp_dir, sample_mbox_content):
+        """Test no index file is written beside Thunderbird style mbox files"""
+        os.makedirs(os.path.join(temp_dir, 'Inbox.sbd'))
+        for filename in ('Inbox', 'Inbox.sbd/Sub'):
+            with open(os.path.join(temp_dir, filename), 'wb') as f:
+                f.write(sample_mbox_content)
+            assert len(imapbackup.scan_file(filename, False, True, temp_dir)) == 2
+            assert imapbackup.read_index(temp_dir, filename) is not None
+
+        assert sorted(os.listdir(temp_dir)) == [imapbackup.MSGID_INDEX_DIR, 'Inbox', 'Inbox.sbd']
+        assert os.listdir(os.path.join(temp_dir, 'Inbox.sbd')) == ['Sub']
+
+    def test_index_tracks_mbox_size(self, temp_dir, sample_mbox_content):
+        """Test an mbox replaced with the same mtime but another size invalidates the index"""
+        mbox_file = os.path.join(temp_dir, "test.mbox")
+        with open(mbox_file, 'wb') as f:
+            f.write(sample_mbox_content)
+        imapbackup.scan_file("test.mbox", False, True, temp_dir)
+        st = os.stat(mbox_file)
+
+        with open(mbox_file, 'wb') as f:
+            f.write(sample_mbox_content[:sample_mbox_content.index(b'\nFrom ') + 1])
+        os.utime(mbox_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        assert not imapbackup.index_is_current(temp_dir, "test.mbox")
+        assert imapbackup.read_index(temp_dir, "test.mbox") is None
+
+    def test_header_value(self):
+        """Test header_value finds headers case-insensitively"""
+        block = b"Subject: hi\nmessage-id: <x@example.com>\n"
+        assert imapbackup.header_value(block, 'Message-Id') == "<x@example.com>"
+        assert imapbackup.header_value(block, 'From') is None
+
+    def test_header_end_crlf_message(self):
+        """Test header_end stops at the first blank line of either line ending"""
+        message = b"Subject: hi\r\n\r\nbody\n\nMessage-Id: <in-body@example.com>\n"
+        end = imapbackup.header_end(message)
+        assert message[:end] == b"Subject: hi\r\n"
+        assert imapbackup.header_value(message[:end], 'Message-Id') is None
+        assert imapbackup.header_end(b"Subject: hi\n\nbody\r\n\r\n") == 12
+
+    def test_iter_mbox_spans(self):
+        """Test message spans match the messages and bound header_end"""
+        mbox = (b"From a@b Mon Jan  1 00:00:00 2024\nMessage-Id: <1@x>\n\none\n\n"
+                b"From a@b Mon Jan  1 00:00:00 2024\r\nMessage-Id: <2@x>\r\n\r\ntwo\r\n\r\n")
+        spans = list(imapbackup.iter_mbox_spans(mbox))
+        assert [mbox[s:e] for s, e in spans] == [b"Message-Id: <1@x>\n\none\n",
+                                                 b"Message-Id: <2@x>\r\n\r\ntwo\r\n"]
+        start, end = spans[1]
+        assert mbox[start:imapbackup.header_end(mbox, start, end)] == b"Message-Id: <2@x>\r\n"
+
+    def test_map_file(self, temp_dir, sample_mbox_content):
+        """Test files are mapped read-only and empty files give b''"""
+        path = os.path.join(temp_dir, 'INBOX.mbox')
+        open(path, 'wb').close()
+        with open(path, 'rb') as f:
+            assert imapbackup.map_file(f) == b''
+
+        with open(path, 'wb') as f:
+            f.write(sample_mbox_content)
+        with open(path, 'rb') as f:
+            mapped = imapbackup.map_file(f)
+            assert mapped[:] == sample_mbox_content
+            mapped.close()
+
+    @patch('imapbackup.retry_on_network_error')
+    def test_download_messages_writes_mbox(self, mock_retry, temp_dir, mock_imap_server):
+        """Test download_messages writes From-quoted messages without forcing gc"""
+        mock_retry.side_effect = lambda func, **kwargs: func()
+
+        def mock_fetch(msg_set, fetch_cmd):
+            data = []
+            for part in msg_set.split(','):
+                start, _, end = part.partition(':')
+                for num in range(int(start), int(end or start) + 1):
+                    body = b'Message-Id: <m%d@example.com>\r\n\r\nHi\r\nFrom me\r\n' % num
+                    if fetch_cmd == '(RFC822.SIZE)':
+                        data.append(b'%d (RFC822.SIZE %d)' % (num, len(body)))
+                        continue
+                    data.append((b'%d (RFC822 {%d}' % (num, len(body)), body))
+                    data.append(b')')
+            return ('OK', data)
+
+        mock_imap_server.fetch.side_effect = mock_fetch
+        messages = {'<m1@example.com>': 1, '<m2@example.com>': 2}
+
+        with patch('imapbackup.gc.collect') as mock_gc:
+            result = imapbackup.download_messages(mock_imap_server, 'INBOX.mbox', messages,
+                                                  False, True, False, temp_dir, False)
+
+        assert result[:2] == (2, 0)
+        assert not mock_gc.called
+        assert [c[0] for c in mock_imap_server.fetch.call_args_list] == \
+            [('1:2', '(RFC822.SIZE)'), ('1:2', '(RFC822)')]
+        with open(os.path.join(temp_dir, 'INBOX.mbox'), 'rb') as f:
+            content = f.read()
+        assert content.count(b'From nobody ') == 2
+        assert b'\n>From me\n' in content
+        assert imapbackup.scan_file('INBOX.mbox', False, True, temp_dir) == \
+            {'<m1@example.com>': '<m1@example.com>', '<m2@example.com>': '<m2@example.com>'}
+
+        # scan_file wrote an index, later downloads append to it
+        imapbackup.download_messages(mock_imap_server, 'INBOX.mbox', {'<m3@example.com>': 3},
+                                     False, True, False, temp_dir, False)
+        index_file = imapbackup.index_path(temp_dir, 'INBOX.mbox')
+        with open(index_file) as f:
+            assert f.readline() == imapbackup.index_stamp(os.path.join(temp_dir, 'INBOX.mbox'))
+            assert f.read().split() == ['<m1@example.com>', '<m2@example.com>', '<m3@example.com>']
+        assert imapbackup.index_is_current(temp_dir, 'INBOX.mbox')
 
 
 @pytest.mark.integration
@@ -224,6 +413,27 @@ class TestGetNames:
                 assert "Inbox" in filename or "INBOX" in filename
 
 
+@pytest.mark.integration
+class TestFolderFilters:
+    """Tests for the folders and exclude-folders account settings"""
+
+    @patch('imapbackup.process_folder')
+    @patch('imapbackup.get_names')
+    @patch('imapbackup.connect_and_login')
+    def test_process_account_folder_filters(self, mock_connect, mock_get_names, mock_process_folder,
+                                            mock_config, temp_dir):
+        """Test the folders and exclude-folders settings select the processed folders"""
+        mock_get_names.return_value = [('INBOX', 'INBOX.mbox'), ('Sent', 'Sent.mbox'), ('Trash', 'Trash.mbox')]
+        config = dict(mock_config, basedir=temp_dir)
+
+        imapbackup.process_account(dict(config, **{'exclude-folders': 'Trash, Spam'}))
+        assert [c[0][1] for c in mock_process_folder.call_args_list] == ['INBOX', 'Sent']
+
+        mock_process_folder.reset_mock()
+        imapbackup.process_account(dict(config, folders=['Sent', 'Missing']))
+        assert [c[0][1] for c in mock_process_folder.call_args_list] == ['Sent']
+
+
 @pytest.mark.unit
 class TestConfigParsing:
     """Tests for configuration parsing"""
@@ -290,6 +500,108 @@ class TestConfigParsing:
         expected_date = time.strftime('%Y-%m-%d')
         assert expected_date in config['basedir']
 
+    @patch('imapbackup.time.strftime', side_effect=['2024-01-01', '2024-01-02'])
+    def test_parse_account_config_date_computed_once(self, mock_strftime):
+        """Test the local folder and S3 prefix use the same date"""
+        account = {'name': 'acc', 'server': 'imap.example.com', 'user': 'u', 'pass': 'p',
+                   'use_date_folders': True}
+        global_config = {'basedir': './backups',
+                         's3': {'enabled': True, 'endpoint': 'e', 'bucket': 'b', 'prefix': 'p'}}
+
+        config = imapbackup.parse_account_config(account, global_config)
+
+        assert config['basedir'] == os.path.join('./backups', 'acc', '2024-01-01')
+        assert config['s3_prefix'] == 'p/acc/2024-01-01'
+        assert mock_strftime.call_count == 1
+
+    def test_parse_account_config_folder_workers(self):
+        """Test folder_workers is inherited from global config and defaults to 1"""
+        account = {'name': 'test-account', 'server': 'imap.example.com', 'user': 'u', 'pass': 'p'}
+
+        assert imapbackup.parse_account_config(account, {})['folder_workers'] == 1
+        assert imapbackup.parse_account_config(account, {'folder_workers': 4})['folder_workers'] == 4
+        with pytest.raises(SystemExit):
+            imapbackup.parse_account_config(dict(account, folder_workers=0), {})
+
+    def test_set_connection_defaults(self):
+        """Test the port follows the SSL setting and explicit values are kept"""
+        config = {'usessl': False}
+        imapbackup.set_connection_defaults(config)
+        assert config == {'usessl': False, 'port': 143, 'timeout': 60}
+
+        config = {'usessl': True, 'port': 1993, 'timeout': 0}
+        imapbackup.set_connection_defaults(config)
+        assert config == {'usessl': True, 'port': 1993, 'timeout': 0}
+
+    def test_check_config_folder_workers(self):
+        """Test --folder-workers must be a positive integer"""
+        config, warnings, errors = imapbackup.check_config(
+            {'server': 'imap.example.com', 'user': 'u', 'usessl': True, 'folder_workers': '3'}, [], [])
+        assert config['folder_workers'] == 3
+        assert errors == []
+
+        config, warnings, errors = imapbackup.check_config(
+            {'server': 'imap.example.com', 'user': 'u', 'usessl': True, 'folder_workers': '0'}, [], [])
+        assert len(errors) == 1
+
+        # validated in config file mode as well
+        config, warnings, errors = imapbackup.check_config(
+            {'config_file': 'config.yaml', 'folder_workers': '-3'}, [], [])
+        assert len(errors) == 1
+
+    def test_parse_account_config_s3_and_gpg(self):
+        """Test account s3/gpg settings override global ones, missing ones use defaults"""
+        global_config = {
+            's3': {'enabled': True, 'endpoint': 'https://s3.example.com', 'bucket': 'global'},
+            'gpg': {'enabled': True, 'recipient': 'global@example.com'},
+        }
+        account = {'name': 'a', 'server': 'imap.example.com', 'user': 'u', 'pass': 'p',
+                   's3': {'bucket': 'mine'}}
+
+        config = imapbackup.parse_account_config(account, global_config)
+        assert config['s3_upload'] is True
+        assert config['s3_endpoint'] == 'https://s3.example.com'
+        assert config['s3_bucket'] == 'mine'
+        assert config['s3_access_key'] == ''
+        assert config['s3_prefix'] == 'backups/a'
+        assert config['gpg_recipient'] == 'global@example.com'
+        assert 'gpg_import_key' not in config
+
+        # a prefix in the account's s3 section does not replace the computed one
+        account['s3']['prefix'] = 'custom/path'
+        assert imapbackup.parse_account_config(account, global_config)['s3_prefix'] == 'backups/a'
+
+    def test_process_cline(self, monkeypatch):
+        """Test command line options are stored under their config keys"""
+        monkeypatch.setattr('sys.argv', ['imapbackup', '-e', '-s', 'imap.example.com', '-u', 'u',
+                                         '-p', 'secret', '-y', '--exclude-folders=Trash',
+                                         '--account=a,b', '--account=c', '--folder-workers=2'])
+        config, warnings, errors = imapbackup.process_cline()
+
+        assert errors == []
+        assert warnings == ["Existing mbox files will be overwritten!"]
+        assert config['usessl'] is True
+        assert config['overwrite'] is True
+        assert config['server'] == 'imap.example.com'
+        assert config['pass'] == 'secret'
+        assert config['exclude-folders'] == 'Trash'
+        assert config['account_filter'] == ['a', 'b', 'c']
+        assert config['folder_workers'] == '2'
+
+    def test_load_config_file(self, temp_dir):
+        """Test load_config_file parses YAML safely and requires accounts"""
+        pytest.importorskip('yaml')
+        config_file = os.path.join(temp_dir, 'config.yaml')
+        with open(config_file, 'w') as f:
+            f.write("global:\n  basedir: /backups\naccounts:\n  - name: a\n    server: imap.example.com\n")
+        config = imapbackup.load_config_file(config_file)
+        assert config['accounts'][0]['server'] == 'imap.example.com'
+
+        with open(config_file, 'w') as f:
+            f.write("accounts: !!python/object/apply:os.getcwd []\n")
+        with pytest.raises(SystemExit):
+            imapbackup.load_config_file(config_file)
+
 
 @pytest.mark.unit
 class TestDirectoryCreation:
@@ -324,3 +636,508 @@ class TestDirectoryCreation:
 
         # Directory should exist
         assert os.path.exists(temp_dir)
+
+
+@pytest.mark.integration
+class TestS3Transfer:
+    """Tests for S3 upload/download backends"""
+
+    @patch('imapbackup.TransferConfig', create=True)
+    @patch('imapbackup.boto3', create=True)
+    @patch('imapbackup.HAS_BOTO3', True)
+    def test_upload_to_s3_uses_boto3(self, mock_boto3, mock_transfer_config, mock_s3_config, temp_dir):
+        """Test upload_to_s3 does a multipart upload through boto3 when available"""
+        file_path = os.path.join(temp_dir, 'INBOX.mbox')
+        open(file_path, 'wb').close()
+
+        with patch('imapbackup.subprocess.run') as mock_run:
+            assert imapbackup.upload_to_s3(file_path, mock_s3_config) is True
+            mock_run.assert_not_called()
+
+        client = mock_boto3.session.Session.return_value.client.return_value
+        client.upload_file.assert_called_once()
+        args = client.upload_file.call_args[0]
+        assert args == (file_path, 'test-bucket', 'backups/test/INBOX.mbox')
+        mock_transfer_config.assert_called_once_with(multipart_chunksize=imapbackup.S3_MULTIPART_CHUNKSIZE,
+                                                     max_concurrency=imapbackup.S3_MAX_CONCURRENCY,
+                                                     io_chunksize=imapbackup.S3_IO_CHUNKSIZE)
+        mock_boto3.session.Session.return_value.client.assert_called_once_with(
+            's3', endpoint_url='https://s3.example.com',
+            aws_access_key_id='test-access-key', aws_secret_access_key='test-secret-key')
+
+    @patch('imapbackup.process_folder')
+    @patch('imapbackup.download_from_s3')
+    @patch('imapbackup.get_names')
+    @patch('imapbackup.connect_and_login')
+    def test_restore_download_drops_index(self, mock_connect, mock_get_names, mock_download,
+                                          mock_process_folder, mock_config, mock_s3_config,
+                                          temp_dir, sample_mbox_content):
+        """Test an mbox replaced from S3 is not scanned through the index of the old one"""
+        mock_get_names.return_value = [('INBOX', 'INBOX.mbox')]
+        mbox_file = os.path.join(temp_dir, 'INBOX.mbox')
+        with open(mbox_file, 'wb') as f:
+            f.write(sample_mbox_content)
+        imapbackup.scan_file('INBOX.mbox', False, True, temp_dir)
+        assert imapbackup.index_is_current(temp_dir, 'INBOX.mbox')
+
+        def download(filename, config, destination_dir):
+            # the restored copy keeps size and mtime, as with cp -p
+            return os.path.join(destination_dir, filename)
+
+        mock_download.side_effect = download
+        config = dict(mock_config, basedir=temp_dir, restore=True, s3_upload=True, **mock_s3_config)
+        imapbackup.process_account(config)
+
+        mock_download.assert_called_once_with('INBOX.mbox', config, temp_dir)
+        assert not os.path.exists(imapbackup.index_path(temp_dir, 'INBOX.mbox'))
+
+    @patch('imapbackup.upload_to_s3')
+    @patch('imapbackup.process_folder')
+    @patch('imapbackup.get_names')
+    @patch('imapbackup.connect_and_login')
+    def test_process_account_uploads_files_in_parallel(self, mock_connect, mock_get_names,
+                                                       mock_process_folder, mock_upload,
+                                                       mock_s3_config, temp_dir, capsys):
+        """Test every mbox is uploaded and each file's output stays in one block"""
+        names = [('INBOX', 'INBOX.mbox'), ('Sent', 'Sent.mbox'), ('Drafts', 'Drafts.mbox')]
+        mock_get_names.return_value = names
+        for foldername, filename in names:
+            open(os.path.join(temp_dir, filename), 'wb').close()
+
+        def upload(file_path, config):
+            print ("  uploaded %s" % os.path.basename(file_path))
+
+        mock_upload.side_effect = upload
+        config = dict(mock_s3_config, server='imap.example.com', user='u',
+                      basedir=temp_dir, s3_upload=True, nospinner=True)
+
+        assert imapbackup.process_account(config) is True
+
+        uploaded = sorted(os.path.basename(c[0][0]) for c in mock_upload.call_args_list)
+        assert uploaded == ['Drafts.mbox', 'INBOX.mbox', 'Sent.mbox']
+        out = capsys.readouterr().out
+        for foldername, filename in names:
+            assert "Processing: %s\n  uploaded %s\n" % (filename, filename) in out
+
+    @patch('imapbackup.S3ReadTimeoutError', type('ReadTimeoutError', (Exception,), {}), create=True)
+    @patch('imapbackup.S3ConnectionError', type('ConnectionError', (Exception,), {}), create=True)
+    @patch('imapbackup.TransferConfig', create=True)
+    @patch('imapbackup.boto3', create=True)
+    @patch('imapbackup.HAS_BOTO3', True)
+    @patch('imapbackup.time.sleep')
+    def test_upload_to_s3_retries_only_network_errors(self, mock_sleep, mock_boto3, mock_transfer_config,
+                                                      mock_s3_config, temp_dir):
+        """Test boto3 connection errors are retried but permanent errors are not"""
+        file_path = os.path.join(temp_dir, 'INBOX.mbox')
+        open(file_path, 'wb').close()
+        client = mock_boto3.session.Session.return_value.client.return_value
+
+        client.upload_file.side_effect = imapbackup.S3ConnectionError("endpoint unreachable")
+        with pytest.raises(Exception):
+            imapbackup.upload_to_s3(file_path, mock_s3_config)
+        assert client.upload_file.call_count == 3
+
+        client.upload_file.reset_mock()
+        client.upload_file.side_effect = ValueError("AccessDenied")
+        with pytest.raises(Exception):
+            imapbackup.upload_to_s3(file_path, mock_s3_config)
+        assert client.upload_file.call_count == 1
+
+    @patch('imapbackup.HAS_BOTO3', False)
+    @patch('imapbackup.subprocess.run')
+    def test_download_from_s3_falls_back_to_cli(self, mock_run, mock_s3_config, temp_dir):
+        """Test download_from_s3 uses the AWS CLI without boto3"""
+        path = imapbackup.download_from_s3('INBOX.mbox', mock_s3_config, temp_dir)
+
+        assert path == os.path.join(temp_dir, 'INBOX.mbox')
+        cmd = mock_run.call_args[0][0]
+        assert cmd[:3] == ['aws', 's3', 'cp']
+        assert 's3://test-bucket/backups/test/INBOX.mbox' in cmd
+
+
+    @patch('imapbackup.TransferConfig', create=True)
+    @patch('imapbackup.boto3', create=True)
+    @patch('imapbackup.HAS_BOTO3', True)
+    def test_list_backups_uses_boto3_paginator(self, mock_boto3, mock_transfer_config, capsys):
+        """Test S3 backups are listed through boto3 without running the AWS CLI"""
+        client = mock_boto3.session.Session.return_value.client.return_value
+        client.get_paginator.return_value.paginate.return_value = [
+            {'Contents': [{'Key': 'backups/acc/2024-01-01/INBOX.mbox'},
+                          {'Key': 'backups/acc/2024-01-01/My Folder.mbox.gpg'}]},
+            {'Contents': [{'Key': 'backups/acc/2024-01-02/INBOX.mbox'}]},
+        ]
+        global_config = {'basedir': '/nonexistent', 'use_date_folders': True,
+                         's3': {'enabled': True, 'endpoint': 'https://s3.example.com', 'bucket': 'b'}}
+
+        with patch('imapbackup.subprocess.run') as mock_run:
+            imapbackup.list_backups(global_config, [{'name': 'acc'}], None)
+            mock_run.assert_not_called()
+
+        client.get_paginator.assert_called_once_with('list_objects_v2')
+        client.get_paginator.return_value.paginate.assert_called_once_with(Bucket='b', Prefix='backups/acc/')
+        out = capsys.readouterr().out
+        assert "Date: 2024-01-02 (1 mbox files)" in out
+        assert "Date: 2024-01-01 (2 mbox files)" in out
+
+    @patch('imapbackup.list_s3_keys')
+    def test_list_backups_skips_s3_for_local_accounts(self, mock_list_s3_keys, capsys):
+        """Test S3 is only listed for accounts that have it enabled"""
+        mock_list_s3_keys.return_value = []
+        global_config = {'basedir': '/nonexistent',
+                         's3': {'enabled': True, 'endpoint': 'https://s3.example.com', 'bucket': 'b'}}
+        accounts = [{'name': 'local', 's3_enabled': False},
+                    {'name': 'remote', 's3': {'bucket': 'own'}}]
+
+        imapbackup.list_backups(global_config, accounts, None)
+
+        mock_list_s3_keys.assert_called_once()
+        config, prefix = mock_list_s3_keys.call_args[0]
+        assert config['s3_bucket'] == 'own'
+        assert config['s3_endpoint'] == 'https://s3.example.com'
+        assert prefix == 'backups/remote/'
+
+    def test_list_backups_local_date_folders(self, temp_dir, capsys):
+        """Test local date folders are listed newest first with their mbox counts"""
+        for date, files in (('2024-01-01', ['INBOX.mbox', 'Sent.mbox', 'notes.txt']),
+                            ('2024-01-02', ['INBOX.mbox']), ('empty', [])):
+            os.makedirs(os.path.join(temp_dir, 'acc', date))
+            for name in files:
+                open(os.path.join(temp_dir, 'acc', date, name), 'w').close()
+        open(os.path.join(temp_dir, 'acc', 'stray.mbox'), 'w').close()
+
+        imapbackup.list_backups({'basedir': temp_dir, 'use_date_folders': True}, [{'name': 'acc'}], None)
+
+        out = capsys.readouterr().out
+        assert out.index("Date: 2024-01-02 (1 mbox files)") < out.index("Date: 2024-01-01 (2 mbox files)")
+        assert "empty" not in out and "stray" not in out
+
+    @patch('imapbackup.HAS_BOTO3', False)
+    @patch('imapbackup.subprocess.run')
+    def test_list_s3_keys_cli_keeps_spaces(self, mock_run, mock_s3_config):
+        """Test keys parsed from 'aws s3 ls' output keep their spaces"""
+        mock_run.return_value = Mock(returncode=0, stdout=(
+            "2024-01-01 10:00:00       12 backups/acc/INBOX.mbox\n"
+            "2024-01-01 10:00:00       34 backups/acc/My  Folder.mbox\n"))
+
+        keys = imapbackup.list_s3_keys(mock_s3_config, 'backups/acc/')
+
+        assert keys == ['backups/acc/INBOX.mbox', 'backups/acc/My  Folder.mbox']
+        assert mock_run.call_args[1]['env']['AWS_ACCESS_KEY_ID'] == 'test-access-key'
+
+
+@pytest.mark.integration
+class TestFolderWorkers:
+    """Tests for processing folders in parallel"""
+
+    @patch('imapbackup.process_folder')
+    @patch('imapbackup.connect_and_login')
+    def test_process_folders_parallel(self, mock_connect, mock_process_folder, mock_config, temp_dir, capsys):
+        """Test every folder is processed and every connection is closed"""
+        main_server = MagicMock()
+        extra_servers = [MagicMock(), MagicMock()]
+        mock_connect.side_effect = extra_servers
+
+        def process(server, foldername, filename, config, basedir):
+            assert config['nospinner'] is True
+            if foldername == 'Broken':
+                raise imapbackup.SkipFolderException("SELECT failed for Broken")
+            print ("done %s" % foldername)
+
+        mock_process_folder.side_effect = process
+        names = [('INBOX', 'INBOX.mbox'), ('Sent', 'Sent.mbox'),
+                 ('Broken', 'Broken.mbox'), ('Drafts', 'Drafts.mbox')]
+
+        imapbackup.process_folders_parallel(main_server, names, mock_config, temp_dir, 3)
+
+        processed = sorted(c[0][1] for c in mock_process_folder.call_args_list)
+        assert processed == ['Broken', 'Drafts', 'INBOX', 'Sent']
+        assert mock_connect.call_count <= 2
+        main_server.logout.assert_called_once()
+        for server in extra_servers[:mock_connect.call_count]:
+            server.logout.assert_called_once()
+
+        out = capsys.readouterr().out
+        for foldername in ('INBOX', 'Sent', 'Drafts'):
+            assert "done %s\n" % foldername in out
+        assert "SELECT failed for Broken" in out
+
+    @patch('imapbackup.process_folder')
+    @patch('imapbackup.connect_and_login')
+    def test_process_folders_parallel_connection_limit(self, mock_connect, mock_process_folder,
+                                                       mock_config, temp_dir, capsys):
+        """Test folders wait for a free connection when the server refuses more"""
+        import time
+        main_server = MagicMock()
+        mock_connect.side_effect = SystemExit(4)
+        mock_process_folder.side_effect = lambda *args: time.sleep(0.05)
+        names = [('INBOX', 'INBOX.mbox'), ('Sent', 'Sent.mbox'), ('Drafts', 'Drafts.mbox')]
+
+        imapbackup.process_folders_parallel(main_server, names, mock_config, temp_dir, 3)
+
+        assert mock_process_folder.call_count == 3
+        assert all(c[0][0] is main_server for c in mock_process_folder.call_args_list)
+        main_server.logout.assert_called_once()
+        assert "waiting for a free one" in capsys.readouterr().out
+
+    @patch('imapbackup.process_folder')
+    @patch('imapbackup.connect_and_login')
+    def test_failed_connection_is_dropped(self, mock_connect, mock_process_folder, mock_config, temp_dir):
+        """Test a connection that failed a folder is closed and not reused"""
+        main_server = MagicMock()
+        fresh_server = MagicMock()
+        mock_connect.return_value = fresh_server
+        used = []
+
+        def process(server, foldername, filename, config, basedir):
+            used.append(server)
+            if foldername == 'Broken':
+                raise imapbackup.SkipFolderException("FETCH failed after retries")
+
+        mock_process_folder.side_effect = process
+        names = [('Broken', 'Broken.mbox'), ('INBOX', 'INBOX.mbox')]
+
+        imapbackup.process_folders_parallel(main_server, names, mock_config, temp_dir, 2)
+
+        assert used[0] is main_server
+        assert used[1] is fresh_server
+        main_server.logout.assert_called_once()
+        fresh_server.logout.assert_called_once()
+
+    @patch('imapbackup.process_folder')
+    def test_connections_closed_on_unexpected_error(self, mock_process_folder, mock_config, temp_dir):
+        """Test connections are logged out even if a folder raises unexpectedly"""
+        main_server = MagicMock()
+        mock_process_folder.side_effect = [None, RuntimeError("boom")]
+        names = [('INBOX', 'INBOX.mbox'), ('Sent', 'Sent.mbox')]
+
+        with patch('imapbackup.connect_and_login', return_value=MagicMock()) as mock_connect:
+            with pytest.raises(RuntimeError):
+                imapbackup.process_folders_parallel(main_server, names, mock_config, temp_dir, 1)
+
+        main_server.logout.assert_called_once()
+
+
+@pytest.mark.integration
+class TestAccountWorkers:
+    """Tests for processing accounts in parallel"""
+
+    @patch('imapbackup.process_account')
+    @patch('imapbackup.load_config_file')
+    @patch('imapbackup.get_config')
+    def test_accounts_in_parallel(self, mock_get_config, mock_load, mock_process_account, capsys):
+        """Test each account's output stays in one block and failures are counted"""
+        import time
+        mock_get_config.return_value = {'config_file': 'config.yaml', 'account_workers': 3}
+        mock_load.return_value = {
+            'global': {'basedir': '/backups'},
+            'accounts': [{'name': name, 'server': 'imap.example.com', 'user': 'u', 'pass': 'p'}
+                         for name in ('one', 'two', 'three')]}
+
+        def process(config):
+            assert config['nospinner'] is True
+            print ("begin %s" % config['account_name'])
+            time.sleep(0.01)
+            print ("end %s" % config['account_name'])
+            return config['account_name'] != 'two'
+
+        mock_process_account.side_effect = process
+
+        with pytest.raises(SystemExit) as exc_info:
+            imapbackup.main()
+
+        assert exc_info.value.code == 1
+        out = capsys.readouterr().out
+        for name in ('one', 'two', 'three'):
+            assert "begin %s\nend %s\n" % (name, name) in out
+        assert "Summary: 2 successful, 1 failed (out of 3 total)" in out
+
+    def test_folder_output_nested(self):
+        """Test folder output is collected into the output of its account"""
+        import threading
+        stream = MagicMock()
+        output = imapbackup.FolderOutput(stream)
+        output.begin()
+        account = output.current()
+        output.write("account\n")
+
+        def folder():
+            output.begin(account)
+            output.write("folder\n")
+            output.end()
+
+        thread = threading.Thread(target=folder)
+        thread.start()
+        thread.join()
+        assert not stream.write.called
+        output.end()
+        stream.write.assert_called_once_with("account\nfolder\n")
+
+
+@pytest.mark.integration
+class TestBufferedConnection:
+    """Tests for the IMAP4 connection with a large read buffer"""
+
+    @patch('imapbackup.IMAP4_SSL')
+    def test_connect_enables_keepalive(self, mock_imap, mock_config):
+        """Test connections get TCP keepalive so idle pooled connections survive"""
+        import socket
+        default_timeout = socket.getdefaulttimeout()
+        try:
+            server = imapbackup.connect_and_login(mock_config)
+        finally:
+            socket.setdefaulttimeout(default_timeout)
+
+        calls = server.sock.setsockopt.call_args_list
+        assert (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in [c[0] for c in calls]
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            assert (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60) in [c[0] for c in calls]
+
+    def test_buffered_imap4_talks_to_server(self, fake_imap_server):
+        """Test greeting and a command round-trip through the replaced reader"""
+        body = b'x' * 100000
+
+        def noop(tag, args, rfile):
+            return b'* 1 FETCH (RFC822 {%d}\r\n' % len(body) + body + b')\r\n' + tag + b' OK done\r\n'
+
+        server = fake_imap_server({b'NOOP': noop}, greeting=b'* OK [CAPABILITY IMAP4rev1] ready')
+        assert server.welcome.startswith(b'* OK')
+        typ, data = server.noop()
+        assert typ == 'OK'
+        assert server.untagged_responses['FETCH'][0][1] == body
+
+
+@pytest.mark.integration
+class TestScanFolder:
+    """Tests for pipelined header FETCH in scan_folder"""
+
+    def scan(self, fake_imap_server, respond):
+        """Runs scan_folder against a fake server, respond(fetches) answers FETCH commands"""
+        fetches = []
+
+        def fetch(tag, args, rfile):
+            fetches.append((tag, args.split(b' ', 1)[0]))
+            return respond(fetches)
+
+        server = fake_imap_server({b'FETCH': fetch}, exists=6)
+        with patch('imapbackup.FETCH_BATCH_SIZE', 2):
+            return imapbackup.scan_folder(server, 'INBOX', True)
+
+    @staticmethod
+    def fetch_data(msg_set):
+        """Returns the untagged Message-Id FETCH responses for a start:end message set"""
+        start, end = map(int, msg_set.split(b':'))
+        out = b''
+        for num in range(start, end + 1):
+            header = b'Message-Id: <m%d@example.com>\r\n\r\n' % num
+            out += b'* %d FETCH (BODY[HEADER.FIELDS (MESSAGE-ID)] {%d}\r\n%s)\r\n' % (num, len(header), header)
+        return out
+
+    def fetch_response(self, tag, msg_set):
+        """Returns the complete response to a Message-Id FETCH"""
+        return self.fetch_data(msg_set) + tag + b' OK FETCH completed\r\n'
+
+    def test_scan_folder_pipelines_fetch(self, fake_imap_server):
+        """Test header FETCH batches are sent before earlier ones are answered"""
+        def respond(fetches):
+            # a client waiting for each response would hang here
+            if len(fetches) == 3:
+                return b''.join(self.fetch_response(*f) for f in fetches)
+            return b''
+
+        messages = self.scan(fake_imap_server, respond)
+        assert messages == dict(('<m%d@example.com>' % i, i) for i in range(1, 7))
+
+    def test_scan_folder_falls_back_on_out_of_order_fetch(self, fake_imap_server):
+        """Test batches answered out of order are fetched again one at a time"""
+        def respond(fetches):
+            if len(fetches) == 3:
+                # the second batch's data arrives before the first one's
+                (tag1, set1), (tag2, set2), third = fetches
+                return (self.fetch_data(set2) + self.fetch_response(tag1, set1) +
+                        tag2 + b' OK FETCH completed\r\n' + self.fetch_response(*third))
+            if len(fetches) > 3:
+                return self.fetch_response(*fetches[-1])
+            return b''
+
+        messages = self.scan(fake_imap_server, respond)
+        assert messages == dict(('<m%d@example.com>' % i, i) for i in range(1, 7))
+
+
+@pytest.mark.integration
+class TestUploadMessages:
+    """Tests for APPENDing messages from an mbox in restore mode"""
+
+    @patch('imapbackup.retry_on_network_error')
+    def test_upload_messages_raw_bytes(self, mock_retry, temp_dir, sample_mbox_content, mock_imap_server):
+        """Test upload_messages appends the raw message bytes from the mbox"""
+        with open(os.path.join(temp_dir, 'INBOX.mbox'), 'wb') as f:
+            f.write(sample_mbox_content)
+        mock_retry.side_effect = lambda func, **kwargs: func()
+        mock_imap_server.append.return_value = ('OK', [b'APPEND completed'])
+
+        result = imapbackup.upload_messages(mock_imap_server, 'INBOX', 'INBOX.mbox',
+                                            {'<test2@example.com>': '<test2@example.com>'},
+                                            True, temp_dir)
+
+        assert result[:2] == (1, 0)
+        appended = mock_imap_server.append.call_args[0][3]
+        assert appended.startswith(b"Message-Id: <test2@example.com>\n")
+        assert appended.endswith(b"This is test message 2.\n")
+
+    def test_upload_messages_pipelines_append(self, temp_dir, sample_mbox_content, fake_imap_server):
+        """Test APPENDs are sent back to back with LITERAL+ before any response is read"""
+        with open(os.path.join(temp_dir, 'INBOX.mbox'), 'wb') as f:
+            f.write(sample_mbox_content)
+        appended = []
+        tags = []
+
+        def append(tag, args, rfile):
+            size = int(args[args.rindex(b'{') + 1:args.rindex(b'+')])
+            appended.append(rfile.read(size))
+            rfile.readline()
+            tags.append(tag)
+            # a client waiting for each response would hang here
+            if len(tags) == 2:
+                return b''.join(t + b' OK APPEND completed\r\n' for t in tags)
+            return b''
+
+        server = fake_imap_server({b'APPEND': append}, capabilities=b'IMAP4rev1 LITERAL+')
+        messages = {'<test1@example.com>': '<test1@example.com>',
+                    '<test2@example.com>': '<test2@example.com>'}
+        result = imapbackup.upload_messages(server, 'INBOX', 'INBOX.mbox', messages, True, temp_dir)
+
+        assert result[:2] == (2, 0)
+        assert len(appended) == 2
+        assert appended[0].startswith(b'Message-Id: <test1@example.com>\r\nFrom: ')
+        assert b'\n' not in appended[0].replace(b'\r\n', b'')
+
+    def test_upload_messages_resends_unacknowledged_append(self, temp_dir, sample_mbox_content,
+                                                           mock_imap_server):
+        """Test a pipelined APPEND lost to a network error is sent again on its own"""
+        import socket
+
+        with open(os.path.join(temp_dir, 'INBOX.mbox'), 'wb') as f:
+            f.write(sample_mbox_content)
+        mock_imap_server.capabilities = ('IMAP4REV1', 'LITERAL+')
+        mock_imap_server.utf8_enabled = False
+        mock_imap_server._encoding = 'ascii'
+        mock_imap_server._new_tag.side_effect = [b'A1', b'A2']
+
+        def complete(name, tag):
+            if tag == b'A2':
+                raise socket.error("connection reset")
+            return ('OK', [b'APPEND completed'])
+
+        mock_imap_server._command_complete.side_effect = complete
+        mock_imap_server.append.return_value = ('OK', [b'APPEND completed'])
+
+        result = imapbackup.upload_messages(mock_imap_server, 'INBOX', 'INBOX.mbox',
+                                            {'<test1@example.com>': '<test1@example.com>',
+                                             '<test2@example.com>': '<test2@example.com>'},
+                                            True, temp_dir)
+
+        assert result[:2] == (2, 0)
+        assert mock_imap_server.send.call_count == 2
+        mock_imap_server.append.assert_called_once()
+        assert mock_imap_server.append.call_args[0][3].startswith(b"Message-Id: <test2@example.com>\n")
+
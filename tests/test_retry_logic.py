@@ -154,6 +154,21 @@ class TestRetryLogic:
             assert 0.1 < delay2 < 0.5    # ~0.2s with tolerance for CI load
             assert delay2 > delay1       # Verify exponential backoff is working
 
+    def test_retry_jitter_and_cap(self):
+        """Test retry delays are jittered and capped at MAX_RETRY_DELAY"""
+        def failing_operation():
+            raise socket.error("Network error")
+
+        with patch('imapbackup.time.sleep') as mock_sleep:
+            with pytest.raises(socket.error):
+                imapbackup.retry_on_network_error(failing_operation, max_retries=5, delay=10.0)
+
+        delays = [c[0][0] for c in mock_sleep.call_args_list]
+        assert len(delays) == 4
+        assert 10.0 <= delays[0] <= 15.0
+        assert 20.0 <= delays[1] <= 30.0
+        assert delays[2] == delays[3] == imapbackup.MAX_RETRY_DELAY
+
     def test_retry_with_operation_name(self, capsys):
         """Test retry with operation name for logging"""
         def failing_operation():
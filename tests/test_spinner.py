@@ -185,3 +185,51 @@ class TestSpinner:
         spinner.update(current=150)
         output_text = ''.join(output)
         assert "75%" in output_text
+
+    def test_spinner_rate_limited(self, monkeypatch):
+        """Test repeated updates within the same percentage are not repainted"""
+        output = []
+
+        monkeypatch.setattr('sys.stdout.write', output.append)
+        monkeypatch.setattr('sys.stdout.flush', lambda: None)
+        monkeypatch.setattr('sys.stdin.isatty', lambda: True)
+
+        spinner = imapbackup.Spinner("Processing", nospinner=False, total=1000)
+        output.clear()
+        for current in range(1, 10):
+            spinner.update(current=current)
+        assert output == []
+
+        # a new percentage and the final count are always shown
+        spinner.update(current=10)
+        assert "10/1000, 1%" in ''.join(output)
+        spinner.update(current=1000)
+        assert "1000/1000, 100%" in ''.join(output)
+
+    def test_spinner_single_write_per_paint(self, monkeypatch):
+        """Test each repaint and the final stop are one write each"""
+        output = []
+
+        monkeypatch.setattr('sys.stdout.write', output.append)
+        monkeypatch.setattr('sys.stdout.flush', lambda: None)
+        monkeypatch.setattr('sys.stdin.isatty', lambda: True)
+
+        spinner = imapbackup.Spinner("Processing", nospinner=False, total=10)
+        output.clear()
+        spinner.update(current=5)
+        assert len(output) == 1
+        output.clear()
+        spinner.stop()
+        assert output == ["\rProcessing (10/10, 100%)  \rProcessing (10/10, 100%)"]
+
+    def test_spinner_percentage_integer_math(self, monkeypatch):
+        """Test the percentage is not rounded down by float error"""
+        output = []
+
+        monkeypatch.setattr('sys.stdout.write', output.append)
+        monkeypatch.setattr('sys.stdout.flush', lambda: None)
+        monkeypatch.setattr('sys.stdin.isatty', lambda: True)
+
+        spinner = imapbackup.Spinner("Processing", nospinner=False, total=100)
+        spinner.update(current=29)
+        assert "29/100, 29%" in ''.join(output)